@@ -0,0 +1,488 @@
+#!/usr/bin/env python2.7
+#
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+# In-process stand-ins for a simplestreams mirror, keystone and glance,
+# used by sync_benchmark.py to drive the sync script without a cloud.
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import collections
+import hashlib
+import json
+import os
+import re
+import shutil
+import SocketServer
+import subprocess
+import tempfile
+import threading
+import urlparse
+import uuid
+
+CONTENT_ID = 'com.example.bench:download'
+REGION = 'RegionOne'
+PAYLOAD_BLOCK = hashlib.sha256('glance-simplestreams-sync').digest() * 2048
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeService(object):
+    """Base class for a fake HTTP service running in a background thread.
+
+    Subclasses implement handle(handler, method, path, query, body) and
+    return (status, headers, body), where body may be an iterator of
+    chunks. Every request is counted per method and route.
+    """
+
+    # maps a request path to the route name it is counted under
+    routes = ()
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _dispatch(self):
+                url = urlparse.urlsplit(self.path)
+                body = service._read_body(self)
+                service.count(self.command, url.path)
+                status, headers, content = service.handle(
+                    self, self.command, url.path,
+                    urlparse.parse_qs(url.query), body)
+                if isinstance(content, str):
+                    content = [content]
+                    headers.setdefault('Content-Length',
+                                       str(len(content[0])))
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                if self.command != 'HEAD':
+                    for chunk in content:
+                        self.wfile.write(chunk)
+
+            do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = _dispatch
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name=self.__class__.__name__)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read_body(self, handler):
+        if handler.headers.get('Transfer-Encoding', '') == 'chunked':
+            return self._read_chunked(handler.rfile)
+        length = int(handler.headers.get('Content-Length', 0))
+        return _LengthReader(handler.rfile, length)
+
+    def _read_chunked(self, rfile):
+        while True:
+            size = int(rfile.readline().split(';')[0], 16)
+            if size == 0:
+                rfile.readline()
+                return
+            yield rfile.read(size)
+            rfile.readline()
+
+    def count(self, method, path):
+        route = path
+        for pattern, name in self.routes:
+            if re.match(pattern, path):
+                route = name
+                break
+        with self.lock:
+            self.calls["{} {}".format(method, route)] += 1
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls.clear()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _LengthReader(object):
+    """Iterates over a request body of known length in chunks."""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def __iter__(self):
+        while self.remaining:
+            buf = self.rfile.read(min(self.remaining, 65536))
+            if not buf:
+                return
+            self.remaining -= len(buf)
+            yield buf
+
+
+def json_response(obj, status=200, headers=None):
+    headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+    return status, headers, json.dumps(obj)
+
+
+def payload(size, start=0):
+    """Yields the synthetic image payload of the given size, from byte
+    start on. Every image has the same content."""
+    offset = start
+    while offset < size:
+        block_offset = offset % len(PAYLOAD_BLOCK)
+        chunk = PAYLOAD_BLOCK[block_offset:block_offset + size - offset]
+        offset += len(chunk)
+        yield chunk
+
+
+def payload_checksums(size):
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    for chunk in payload(size):
+        sha256.update(chunk)
+        md5.update(chunk)
+    return sha256.hexdigest(), md5.hexdigest()
+
+
+class GpgSigner(object):
+    """Clearsigns stream metadata with a throwaway key, and exports the
+    matching keyring for the sync script to verify against."""
+
+    def __init__(self, workdir):
+        self.home = os.path.join(workdir, 'gnupg')
+        os.mkdir(self.home, 0o700)
+        params = ["Key-Type: RSA", "Key-Length: 1024",
+                  "Name-Real: glance-simplestreams-sync benchmark",
+                  "Expire-Date: 0"]
+        version = self._gpg(['--version'])
+        if not version.startswith('gpg (GnuPG) 1.'):
+            params.append("%no-protection")
+        params.append("%commit")
+        self._gpg(['--gen-key'], "\n".join(params) + "\n")
+        self.keyring = os.path.join(workdir, 'bench-keyring.gpg')
+        with open(self.keyring, 'wb') as f:
+            f.write(self._gpg(['--export']))
+
+    def _gpg(self, args, data=None):
+        proc = subprocess.Popen(['gpg', '--homedir', self.home, '--batch',
+                                 '--quiet'] + args,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate(data)
+        if proc.returncode != 0:
+            raise RuntimeError("gpg {} failed: {}".format(args, err))
+        return out
+
+    def sign(self, content):
+        return self._gpg(['--clearsign'], content)
+
+    def cleanup(self):
+        shutil.rmtree(self.home, ignore_errors=True)
+
+
+class FakeMirror(FakeService):
+    """Serves a synthetic simplestreams mirror.
+
+    The mirror has nproducts products with nversions versions each, and
+    every version has one disk1.img item of image_size bytes. Metadata
+    is served with an ETag and honours If-None-Match, and images honour
+    Range requests, like cloud-images.ubuntu.com.
+    """
+
+    routes = ((r'^/streams/', 'metadata'), (r'^/images/', 'image'))
+
+    def __init__(self, nproducts, nversions, image_size, signer=None):
+        super(FakeMirror, self).__init__()
+        self.image_size = image_size
+        self.signer = signer
+        self.bytes_served = 0
+        ext = 'sjson' if signer else 'json'
+        self.index_path = 'streams/v1/index.{}'.format(ext)
+        self.documents = {}
+        self.products = self._products(nproducts, nversions)
+        self.publish()
+
+    def _products(self, nproducts, nversions):
+        sha256, md5 = payload_checksums(self.image_size)
+        products = {}
+        for p in range(nproducts):
+            name = 'com.example.bench:{:04d}:amd64'.format(p)
+            versions = {}
+            for v in range(nversions):
+                vname = '2014{:04d}'.format(v + 1)
+                versions[vname] = {
+                    'pubname': 'bench-{:04d}-{}-amd64'.format(p, vname),
+                    'items': {'disk1.img': {
+                        'ftype': 'disk1.img',
+                        'path': 'images/{}/{}/disk1.img'.format(p, vname),
+                        'size': self.image_size,
+                        'sha256': sha256,
+                        'md5': md5}}}
+            products[name] = {'arch': 'amd64', 'os': 'ubuntu',
+                              'release': 'bench{:04d}'.format(p),
+                              'version': '14.04', 'versions': versions}
+        return products
+
+    def publish(self):
+        """(Re)generates the index and products documents."""
+        ext = self.index_path.rsplit('.', 1)[1]
+        products_path = 'streams/v1/{}.{}'.format(CONTENT_ID, ext)
+        products_doc = {'format': 'products:1.0', 'content_id': CONTENT_ID,
+                        'datatype': 'image-downloads',
+                        'updated': 'Mon, 01 Jan 2014 00:00:00 +0000',
+                        'products': self.products}
+        index_doc = {'format': 'index:1.0',
+                     'updated': 'Mon, 01 Jan 2014 00:00:00 +0000',
+                     'index': {CONTENT_ID: {
+                         'path': products_path,
+                         'format': 'products:1.0',
+                         'datatype': 'image-downloads',
+                         'updated': 'Mon, 01 Jan 2014 00:00:00 +0000',
+                         'products': sorted(self.products)}}}
+        for path, doc in ((products_path, products_doc),
+                          (self.index_path, index_doc)):
+            content = json.dumps(doc, indent=1, sort_keys=True)
+            if self.signer:
+                content = self.signer.sign(content)
+            self.documents['/' + path] = content
+
+    def add_version(self, vname):
+        """Adds version vname to every product, as a daily build would."""
+        sha256, md5 = payload_checksums(self.image_size)
+        for p, product in enumerate(sorted(self.products)):
+            self.products[product]['versions'][vname] = {
+                'pubname': 'bench-{:04d}-{}-amd64'.format(p, vname),
+                'items': {'disk1.img': {
+                    'ftype': 'disk1.img',
+                    'path': 'images/{}/{}/disk1.img'.format(p, vname),
+                    'size': self.image_size,
+                    'sha256': sha256,
+                    'md5': md5}}}
+        self.publish()
+
+    def handle(self, handler, method, path, query, body):
+        if path in self.documents:
+            content = self.documents[path]
+            etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+            if handler.headers.get('If-None-Match') == etag:
+                return 304, {'ETag': etag, 'Content-Length': '0'}, ''
+            return 200, {'ETag': etag}, content
+
+        if path.startswith('/images/'):
+            start = 0
+            status = 200
+            headers = {'ETag': '"bench-image"'}
+            match = re.match(r'bytes=(\d+)-$', handler.headers.get('Range',
+                                                                   ''))
+            if match and int(match.group(1)) < self.image_size:
+                start = int(match.group(1))
+                status = 206
+                headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                    start, self.image_size - 1, self.image_size)
+            headers['Content-Length'] = str(self.image_size - start)
+            with self.lock:
+                self.bytes_served += self.image_size - start
+            return status, headers, payload(self.image_size, start)
+
+        return 404, {'Content-Length': '0'}, ''
+
+
+class FakeKeystone(FakeService):
+    """Keystone v2.0 with one admin user and a catalog pointing at a
+    FakeGlance."""
+
+    routes = ((r'^/v2.0/tokens$', 'tokens'),
+              (r'^/v2.0/OS-KSADM/services', 'services'),
+              (r'^/v2.0/endpoints', 'endpoints'),
+              (r'^/v2.0/tenants', 'tenants'))
+
+    def __init__(self, glance_url):
+        super(FakeKeystone, self).__init__()
+        self.glance_url = glance_url
+        self.tenant_id = 'bench-tenant'
+        self.services = [
+            {'id': 'svc-keystone', 'name': 'keystone', 'type': 'identity',
+             'description': ''},
+            {'id': 'svc-glance', 'name': 'glance', 'type': 'image',
+             'description': ''}]
+
+    def catalog(self):
+        identity = self.url + '/v2.0'
+        return [
+            {'type': 'identity', 'name': 'keystone',
+             'endpoints': [{'region': REGION, 'publicURL': identity,
+                            'internalURL': identity,
+                            'adminURL': identity}]},
+            {'type': 'image', 'name': 'glance',
+             'endpoints': [{'region': REGION,
+                            'publicURL': self.glance_url,
+                            'internalURL': self.glance_url,
+                            'adminURL': self.glance_url}]}]
+
+    def handle(self, handler, method, path, query, body):
+        for chunk in body:
+            pass
+        if path == '/v2.0/tokens' and method == 'POST':
+            return json_response({'access': {
+                'token': {'id': uuid.uuid4().hex,
+                          'expires': '2099-01-01T00:00:00Z',
+                          'tenant': {'id': self.tenant_id,
+                                     'name': 'admin'}},
+                'serviceCatalog': self.catalog(),
+                'user': {'id': 'bench-user', 'name': 'admin',
+                         'roles': [{'name': 'admin'}]},
+                'metadata': {'is_admin': 0, 'roles': []}}})
+        if path == '/v2.0/OS-KSADM/services':
+            return json_response({'OS-KSADM:services': self.services})
+        if path == '/v2.0/endpoints':
+            return json_response({'endpoints': []})
+        if path == '/v2.0/tenants':
+            tenants = [{'id': self.tenant_id, 'name': 'admin',
+                        'enabled': True},
+                       {'id': 'bench-services', 'name': 'services',
+                        'enabled': True}]
+            if 'name' in query:
+                for tenant in tenants:
+                    if tenant['name'] == query['name'][0]:
+                        return json_response({'tenant': tenant})
+                return json_response({'error': {'code': 404}}, status=404)
+            return json_response({'tenants': tenants})
+        return json_response({'error': {'code': 404}}, status=404)
+
+
+class FakeGlance(FakeService):
+    """Glance v1 image API keeping image records in memory.
+
+    Uploaded data is read and checksummed like glance does, but thrown
+    away.
+    """
+
+    routes = ((r'^/v1/images/detail$', 'images/detail'),
+              (r'^/v1/images/[^/]+$', 'images/<id>'),
+              (r'^/v1/images$', 'images'))
+
+    def __init__(self):
+        super(FakeGlance, self).__init__()
+        self.images = collections.OrderedDict()
+        self.bytes_received = 0
+
+    def _image_from_headers(self, headers):
+        image = {'id': uuid.uuid4().hex, 'status': 'active',
+                 'properties': {}, 'deleted': False,
+                 'owner': 'bench-tenant'}
+        for key, value in headers.items():
+            key = key.lower()
+            if key.startswith('x-image-meta-property-'):
+                image['properties'][key[len('x-image-meta-property-'):]] = \
+                    value
+            elif key.startswith('x-image-meta-'):
+                image[key[len('x-image-meta-'):].replace('-', '_')] = value
+        return image
+
+    def handle(self, handler, method, path, query, body):
+        if path == '/v1/images' and method == 'POST':
+            image = self._image_from_headers(handler.headers)
+            md5 = hashlib.md5()
+            size = 0
+            for chunk in body:
+                md5.update(chunk)
+                size += len(chunk)
+            with self.lock:
+                self.bytes_received += size
+            if image.get('checksum') and image['checksum'] != \
+                    md5.hexdigest():
+                return json_response({'error': 'checksum mismatch'},
+                                     status=400)
+            image['checksum'] = md5.hexdigest()
+            image['size'] = size
+            with self.lock:
+                self.images[image['id']] = image
+            return json_response({'image': image}, status=201)
+
+        for chunk in body:
+            pass
+
+        if path == '/v1/images/detail':
+            limit = int(query.get('limit', ['20'])[0])
+            marker = query.get('marker', [None])[0]
+            with self.lock:
+                ids = list(self.images)
+            if marker in ids:
+                ids = ids[ids.index(marker) + 1:]
+            return json_response({'images': [self.images[i]
+                                              for i in ids[:limit]]})
+
+        image_id = path.rsplit('/', 1)[-1]
+        if image_id not in self.images:
+            return json_response({'error': 'not found'}, status=404)
+        if method == 'DELETE':
+            with self.lock:
+                del self.images[image_id]
+            return 200, {'Content-Length': '0'}, ''
+        image = self.images[image_id]
+        headers = dict(('x-image-meta-{}'.format(k), str(v))
+                       for k, v in image.items() if k != 'properties')
+        headers.update(('x-image-meta-property-{}'.format(k), str(v))
+                       for k, v in image['properties'].items())
+        return 200, headers, ''
+
+
+class FakeCloud(object):
+    """A FakeMirror, FakeGlance and FakeKeystone started together."""
+
+    def __init__(self, nproducts, nversions, image_size, signed=True):
+        self.workdir = tempfile.mkdtemp(prefix='gss-bench-')
+        self.signer = GpgSigner(self.workdir) if signed else None
+        self.mirror = FakeMirror(nproducts, nversions, image_size,
+                                 self.signer)
+        self.glance = FakeGlance()
+        self.keystone = FakeKeystone(self.glance.url)
+
+    @property
+    def services(self):
+        return {'mirror': self.mirror, 'glance': self.glance,
+                'keystone': self.keystone}
+
+    def api_calls(self):
+        calls = {}
+        for name, service in self.services.items():
+            for route, count in service.calls.items():
+                calls["{} {}".format(name, route)] = count
+        return calls
+
+    def reset_counts(self):
+        for service in self.services.values():
+            service.reset_counts()
+
+    def stop(self, keep_workdir=False):
+        for service in self.services.values():
+            service.stop()
+        if keep_workdir:
+            if self.signer:
+                self.signer.cleanup()
+        else:
+            shutil.rmtree(self.workdir, ignore_errors=True)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python2.7
+#
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares the ItemMatcher of scripts/glance-simplestreams-sync.py with
+# simplestreams' own item filtering on a synthetic products tree:
+#
+#   python2.7 benchmarks/filter_benchmark.py --items 50000 \
+#       --filter release=trusty --filter 'arch~(x86_64|amd64)'
+#
+# Both must select the same items; the times are the best of --repeat
+# passes over every item of the tree.
+
+import argparse
+import imp
+import sys
+import time
+
+from simplestreams import filters
+
+from sync_benchmark import SCRIPT
+
+RELEASES = ['precise', 'trusty', 'utopic', 'vivid', 'wily']
+ARCHES = ['amd64', 'arm64', 'armhf', 'i386', 'ppc64el']
+FTYPES = ['disk1.img', 'disk.img', 'tar.gz', 'root.tar.xz', 'manifest',
+          'uefi1.img', 'vhd', 'ova', 'lxd.tar.xz', 'squashfs']
+
+DEFAULT_FILTERS = ['release=trusty', 'arch~(x86_64|amd64)',
+                   'ftype~(disk1.img|disk.img)']
+
+
+def make_tree(items):
+    """Returns a products tree with about items items, and the pedigree
+    of each of them."""
+    products = {}
+    pedigrees = []
+    per_product = len(FTYPES)
+    versions = max(1, items // (len(RELEASES) * len(ARCHES) * per_product))
+    for release in RELEASES:
+        for arch in ARCHES:
+            name = 'com.ubuntu.cloud:server:{}:{}'.format(release, arch)
+            product = {'release': release, 'arch': arch, 'os': 'ubuntu',
+                       'version': release, 'versions': {}}
+            for v in range(versions):
+                version_name = '2015{:04d}'.format(v)
+                version = {'label': 'release', 'pubname': 'ubuntu-{}-{}-'
+                           '{}'.format(release, arch, version_name),
+                           'items': {}}
+                for ftype in FTYPES:
+                    version['items'][ftype] = {
+                        'ftype': ftype, 'size': 1024,
+                        'path': 'server/{}/{}/{}'.format(
+                            release, version_name, ftype),
+                        'sha256': '0' * 64}
+                    pedigrees.append((name, version_name, ftype))
+                product['versions'][version_name] = version
+            products[name] = product
+    tree = {'content_id': 'com.ubuntu.cloud:released:download',
+            'format': 'products:1.0', 'datatype': 'image-downloads',
+            'products': products}
+    return tree, pedigrees
+
+
+def best_of(repeat, func):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        times.append(time.time() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark item_filters evaluation on a synthetic "
+        "products tree.")
+    parser.add_argument('--items', type=int, default=50000)
+    parser.add_argument('--filter', action='append', dest='filters',
+                        help="an item filter, may be repeated; defaults to "
+                        "{}".format(' '.join(DEFAULT_FILTERS)))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    item_filters = args.filters or DEFAULT_FILTERS
+
+    gss = imp.load_source('glance_simplestreams_sync', SCRIPT)
+    tree, pedigrees = make_tree(args.items)
+
+    def items(p):
+        return tree['products'][p[0]]['versions'][p[1]]['items'][p[2]]
+
+    def simplestreams_pass():
+        parsed = filters.get_filters(item_filters)
+        return [p for p in pedigrees
+                if filters.filter_item(parsed, items(p), tree, p)]
+
+    def matcher_pass():
+        matcher = gss.ItemMatcher(item_filters)
+        return [p for p in pedigrees if matcher.matches(tree, p)]
+
+    baseline, expected = best_of(args.repeat, simplestreams_pass)
+    seconds, selected = best_of(args.repeat, matcher_pass)
+    if selected != expected:
+        print("ItemMatcher selected {} items, simplestreams {}".format(
+            len(selected), len(expected)))
+        return 1
+
+    print("{} items, {} selected by {}".format(len(pedigrees),
+                                               len(selected),
+                                               ' '.join(item_filters)))
+    for name, t in (('simplestreams', baseline), ('ItemMatcher', seconds)):
+        print("    {:<14} {:8.3f}s {:>10.0f} items/s".format(
+            name, t, len(pedigrees) / t))
+    print("speedup: {:.1f}x".format(baseline / seconds))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
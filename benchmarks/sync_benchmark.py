@@ -0,0 +1,280 @@
+#!/usr/bin/env python2.7
+#
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measures sync throughput of scripts/glance-simplestreams-sync.py
+# against the fakes in fake_cloud.py, without a cloud:
+#
+#   python2.7 benchmarks/sync_benchmark.py --products 20 --versions 3 \
+#       --image-size 8M --download-workers 2 --upload-workers 2
+#
+# The first run syncs every image into an empty glance; later runs
+# resync an unchanged mirror, or with --new-version, a mirror that
+# gained one version of every product.
+
+import argparse
+import imp
+import json
+import logging
+import os
+import re
+import resource
+import sys
+import time
+
+import yaml
+
+from fake_cloud import CONTENT_ID, REGION, FakeCloud
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      os.pardir, 'scripts', 'glance-simplestreams-sync.py')
+
+
+class NullStatusExchange(object):
+    """Counts status messages instead of sending them to rabbitmq."""
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, msg, **kwargs):
+        self.sent += 1
+
+    def close(self):
+        pass
+
+
+def parse_size(text):
+    match = re.match(r'^(\d+)([KMG]?)$', text.upper())
+    if not match:
+        raise argparse.ArgumentTypeError("invalid size: {}".format(text))
+    return int(match.group(1)) * 1024 ** ' KMG'.index(match.group(2) or ' ')
+
+
+def load_sync_script(workdir, verbose):
+    """Imports the sync script with every path it writes to moved into
+    workdir."""
+    gss = imp.load_source('glance_simplestreams_sync', SCRIPT)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = logging.StreamHandler() if verbose else logging.NullHandler()
+    handler.setFormatter(logging.Formatter(
+        '%(levelname)-9s %(threadName)s %(name)s: %(message)s'))
+    root.addHandler(handler)
+    root.setLevel('DEBUG' if verbose else 'WARNING')
+
+    conf_dir = os.path.join(workdir, 'etc')
+    cache_dir = os.path.join(workdir, 'cache')
+    for directory in (conf_dir, cache_dir):
+        os.mkdir(directory)
+
+    gss.CONF_FILE_DIR = conf_dir
+    gss.CHARM_CONF_FILE_NAME = os.path.join(conf_dir, 'mirrors.yaml')
+    gss.ID_CONF_FILE_NAME = os.path.join(conf_dir, 'identity.yaml')
+    gss.SYNC_RUNNING_FLAG_FILE_NAME = os.path.join(workdir, 'sync.pid')
+    gss.RERUN_REQUEST_FILE_NAME = os.path.join(workdir, 'sync.rerun')
+    gss.CRON_POLL_FILENAME = os.path.join(workdir, 'fastpoll')
+    gss.REPORT_FILE_NAME = os.path.join(workdir, 'report.json')
+    gss.PROFILE_FILE_NAME = os.path.join(workdir, 'sync.prof')
+    gss.CACHE_DIR = cache_dir
+    gss.METADATA_CACHE_DIR = os.path.join(cache_dir, 'metadata')
+    gss.MIRROR_STATE_FILE_NAME = os.path.join(cache_dir,
+                                              'mirror-state.json')
+    gss.SIGNATURE_CACHE_DIR = os.path.join(cache_dir, 'signatures')
+    gss.PARTIAL_DOWNLOAD_DIR = os.path.join(cache_dir, 'partial')
+    gss.IMAGE_INDEX_FILE_NAME = os.path.join(cache_dir, 'image-index.json')
+    gss.KEYSTONE_TOKEN_FILE_NAME = os.path.join(cache_dir,
+                                                'keystone-token.json')
+    gss.PRODUCT_STREAMS_STATE_FILE_NAME = os.path.join(
+        cache_dir, 'product-streams.json')
+    gss.STATUS_SPOOL_FILE_NAME = os.path.join(cache_dir,
+                                              'status-spool.jsonl')
+    gss.METRICS_STATE_FILE_NAME = os.path.join(cache_dir,
+                                               'metrics-state.json')
+
+    gss.mirror_state = gss.StateFile(gss.MIRROR_STATE_FILE_NAME)
+    gss.image_index = gss.ImageIndex(gss.IMAGE_INDEX_FILE_NAME,
+                                     gss.IMAGE_INDEX_MAX_AGE)
+    gss.keystone_clients = gss.KeystoneClientCache(
+        gss.StateFile(gss.KEYSTONE_TOKEN_FILE_NAME, mode=0o600),
+        gss.KEYSTONE_TOKEN_MIN_LIFETIME)
+    gss.openstack.get_ksclient = gss.keystone_clients.get_client
+    gss.product_streams_state = gss.StateFile(
+        gss.PRODUCT_STREAMS_STATE_FILE_NAME)
+    gss.metrics_state = gss.StateFile(gss.METRICS_STATE_FILE_NAME)
+    gss.sync_lock = gss.SyncLock(gss.SYNC_RUNNING_FLAG_FILE_NAME,
+                                 gss.RERUN_REQUEST_FILE_NAME)
+    return gss
+
+
+def write_conf(gss, cloud, args):
+    """Writes identity.yaml and mirrors.yaml for the fake cloud, like
+    the charm hooks would. With several mirrors, each syncs its own
+    share of the products."""
+    host, port = cloud.keystone.url.rsplit('/', 1)[1].split(':')
+    id_conf = {'service_protocol': 'http', 'service_host': host,
+               'service_port': int(port), 'admin_user': 'admin',
+               'admin_password': 'secret', 'admin_tenant_id': 'bench-tenant'}
+
+    releases = [p['release'] for _, p in sorted(cloud.mirror.products.items())]
+    mirror_list = []
+    for n in range(args.mirrors):
+        mine = releases[n::args.mirrors]
+        mirror_list.append({
+            'url': cloud.mirror.url + '/',
+            'name_prefix': 'bench{}:'.format(n),
+            'path': cloud.mirror.index_path,
+            'max': args.max_items,
+            'item_filters': ['release~^({})$'.format('|'.join(mine)),
+                             'ftype~(disk1.img|disk.img)']})
+
+    charm_conf = {'mirror_list': mirror_list,
+                  'max_concurrent_mirrors': args.concurrent_mirrors,
+                  'image_download_workers': args.download_workers,
+                  'image_upload_workers': args.upload_workers,
+                  'image_queue_size': args.queue_size,
+                  'stream_image_uploads': args.stream_uploads,
+                  'profile_sync': args.profile,
+                  'modify_hook_scripts': '/bin/true',
+                  'name_prefix': 'bench:',
+                  'use_swift': False,
+                  'region': REGION,
+                  'cloud_name': 'bench',
+                  'content_id_template': CONTENT_ID + ':{region}'}
+
+    for filename, conf in ((gss.ID_CONF_FILE_NAME, id_conf),
+                           (gss.CHARM_CONF_FILE_NAME, charm_conf)):
+        with open(filename, 'w') as f:
+            yaml.safe_dump(conf, f)
+    return id_conf, charm_conf
+
+
+def run_once(gss, cloud, args):
+    cloud.reset_counts()
+    gss.profiler.reset(profile=args.profile)
+    images_before = len(cloud.glance.images)
+    received_before = cloud.glance.bytes_received
+    served_before = cloud.mirror.bytes_served
+    status_exchange = NullStatusExchange()
+
+    start = time.time()
+    if args.mode == 'main':
+        try:
+            gss.main([])
+        except SystemExit as e:
+            if e.code:
+                raise
+    else:
+        id_conf, charm_conf = gss.get_conf()
+        gss.set_openstack_env(id_conf, charm_conf)
+        gss.do_sync(charm_conf, status_exchange)
+        gss.profiler.finish()
+    seconds = time.time() - start
+
+    uploaded = cloud.glance.bytes_received - received_before
+    items = cloud.glance.calls['POST images']
+    return {'seconds': seconds,
+            'items': items,
+            'items_per_second': items / seconds,
+            'bytes_downloaded': cloud.mirror.bytes_served - served_before,
+            'bytes_uploaded': uploaded,
+            'mb_per_second': uploaded / seconds / 1024 / 1024,
+            'images_in_glance': len(cloud.glance.images),
+            'images_added': len(cloud.glance.images) - images_before,
+            'status_messages': status_exchange.sent,
+            'api_calls': cloud.api_calls(),
+            'phases': gss.profiler.report()['phases']}
+
+
+def print_run(n, result):
+    print("run {}: {:.2f}s, {} items ({:.2f} items/s), "
+          "{:.2f} MB/s uploaded, {} bytes downloaded, "
+          "{} images in glance".format(
+              n, result['seconds'], result['items'],
+              result['items_per_second'], result['mb_per_second'],
+              result['bytes_downloaded'], result['images_in_glance']))
+    for name, count in sorted(result['api_calls'].items()):
+        print("    {:<40} {:>6}".format(name, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark glance-simplestreams-sync against a fake "
+        "simplestreams mirror, keystone and glance.")
+    parser.add_argument('--products', type=int, default=10)
+    parser.add_argument('--versions', type=int, default=2)
+    parser.add_argument('--image-size', type=parse_size, default='4M',
+                        help="size of every image, e.g. 512K or 16M")
+    parser.add_argument('--max-items', type=int, default=2,
+                        help="versions kept per product (mirror 'max')")
+    parser.add_argument('--mirrors', type=int, default=1)
+    parser.add_argument('--concurrent-mirrors', type=int, default=1)
+    parser.add_argument('--download-workers', type=int, default=1)
+    parser.add_argument('--upload-workers', type=int, default=1)
+    parser.add_argument('--queue-size', type=int, default=1)
+    parser.add_argument('--stream-uploads', action='store_true')
+    parser.add_argument('--unsigned', action='store_true',
+                        help="serve index.json instead of signed sjson")
+    parser.add_argument('--runs', type=int, default=2)
+    parser.add_argument('--new-version', action='store_true',
+                        help="publish a new version before each rerun")
+    parser.add_argument('--mode', choices=['do_sync', 'main'],
+                        default='do_sync')
+    parser.add_argument('--profile', action='store_true',
+                        help="set profile_sync and keep the cProfile dump")
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write the results to FILE")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    cloud = FakeCloud(args.products, args.versions, args.image_size,
+                      signed=not args.unsigned)
+    try:
+        gss = load_sync_script(cloud.workdir, args.verbose)
+        if cloud.signer:
+            gss.KEYRING = cloud.signer.keyring
+        gss.signature_cache = gss.SignatureCache(
+            gss.SIGNATURE_CACHE_DIR, gss.KEYRING,
+            gss.SIGNATURE_CACHE_MAX_ENTRIES)
+        write_conf(gss, cloud, args)
+
+        results = []
+        for n in range(args.runs):
+            if n and args.new_version:
+                cloud.mirror.add_version('2015{:04d}'.format(n))
+            result = run_once(gss, cloud, args)
+            print_run(n + 1, result)
+            results.append(result)
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print("peak RSS of benchmark process: {} KiB".format(peak_rss))
+        if args.profile:
+            print("cProfile dump: {}".format(gss.PROFILE_FILE_NAME))
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'args': vars(args), 'runs': results,
+                           'peak_rss_kib': peak_rss}, f, indent=1,
+                          sort_keys=True)
+    finally:
+        cloud.stop(keep_workdir=args.profile)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
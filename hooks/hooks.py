@@ -23,11 +23,13 @@
 
 import glob
 import os
+import subprocess
 import sys
 import shutil
 
 from charmhelpers.fetch import apt_install, add_source, apt_update
 from charmhelpers.core import hookenv
+from charmhelpers.core.host import service_restart, service_stop
 from charmhelpers.payload.execd import execd_preinstall
 
 from charmhelpers.contrib.openstack.context import (AMQPContext,
@@ -46,8 +48,16 @@ SYNC_SCRIPT_NAME = "glance-simplestreams-sync.py"
 SCRIPT_WRAPPER_NAME = "glance-simplestreams-sync.sh"
 
 CRON_JOB_FILENAME = 'glance_simplestreams_sync'
-CRON_POLL_FILENAME = 'glance_simplestreams_sync_fastpoll'
-CRON_POLL_FILEPATH = os.path.join('/etc/cron.d', CRON_POLL_FILENAME)
+# installed by earlier charm versions, replaced by the wait job
+CRON_POLL_FILEPATH = '/etc/cron.d/glance_simplestreams_sync_fastpoll'
+
+WAIT_JOB_NAME = 'glance-simplestreams-sync-wait'
+WAIT_JOB_FILENAME = WAIT_JOB_NAME + '.conf'
+WAIT_JOB_FILEPATH = os.path.join('/etc/init', WAIT_JOB_FILENAME)
+
+UPSTART_JOB_NAME = 'glance-simplestreams-sync'
+UPSTART_JOB_FILENAME = UPSTART_JOB_NAME + '.conf'
+UPSTART_JOB_FILEPATH = os.path.join('/etc/init', UPSTART_JOB_FILENAME)
 
 hooks = hookenv.Hooks()
 
@@ -92,6 +102,18 @@ class MirrorsConfigServiceContext(OSContextGenerator):
             modify_hook_scripts.append('/bin/true')
 
         return dict(mirror_list=config['mirror_list'],
+                    max_concurrent_mirrors=config['max_concurrent_mirrors'],
+                    image_download_workers=config['image_download_workers'],
+                    image_upload_workers=config['image_upload_workers'],
+                    image_queue_size=config['image_queue_size'],
+                    stream_image_uploads=config['stream_image_uploads'],
+                    profile_sync=config['profile_sync'],
+                    progress_min_interval=config['progress_min_interval'],
+                    progress_min_percent=config['progress_min_percent'],
+                    metrics_textfile_dir=config['metrics_textfile_dir'],
+                    metrics_port=config['metrics_port'],
+                    log_level=config['log_level'],
+                    frequency=config['frequency'],
                     modify_hook_scripts=', '.join(modify_hook_scripts),
                     name_prefix=config['name_prefix'],
                     content_id_template=config['content_id_template'],
@@ -109,8 +131,8 @@ configs.register(ID_CONF_FILE_NAME, [IdentityServiceContext(),
                                      AMQPContext()])
 
 
-def install_cron_script():
-    """Installs cron job in /etc/cron.$frequency/ for repeating sync
+def install_sync_script():
+    """Copies the sync script and its wrapper to /usr/share.
 
     Script is not a template but we always overwrite, to ensure it is
     up-to-date.
@@ -119,6 +141,11 @@ def install_cron_script():
     for fn in [SYNC_SCRIPT_NAME, SCRIPT_WRAPPER_NAME]:
         shutil.copy(os.path.join("scripts", fn), USR_SHARE_DIR)
 
+
+def install_cron_script():
+    """Installs cron job in /etc/cron.$frequency/ for repeating sync"""
+    install_sync_script()
+
     config = hookenv.config()
     installed_script = os.path.join(USR_SHARE_DIR, SCRIPT_WRAPPER_NAME)
     linkname = '/etc/cron.{f}/{s}'.format(f=config['frequency'],
@@ -126,10 +153,14 @@ def install_cron_script():
     os.symlink(installed_script, linkname)
 
 
-def install_cron_poll():
-    "Installs /etc/cron.d every-minute job in crontab for quick polling."
-    poll_file_source = os.path.join('scripts', CRON_POLL_FILENAME)
-    shutil.copy(poll_file_source, '/etc/cron.d/')
+def install_wait_job():
+    """Installs and starts the upstart task that waits for glance to
+    appear in keystone, backing off between checks, and then syncs
+    once. It replaces polling from cron every minute."""
+    install_sync_script()
+    shutil.copy(os.path.join('scripts', WAIT_JOB_FILENAME), '/etc/init/')
+    # 'service start' would block the hook until the task finishes
+    subprocess.call(['initctl', 'start', '--no-wait', WAIT_JOB_NAME])
 
 
 def uninstall_cron_script():
@@ -139,12 +170,31 @@ def uninstall_cron_script():
             os.remove(fn)
 
 
-def uninstall_cron_poll():
-    "Removes cron poll"
+def uninstall_wait_job():
+    "Stops and removes the wait job, and any cron poll left from upgrades"
+    if os.path.exists(WAIT_JOB_FILEPATH):
+        service_stop(WAIT_JOB_NAME)
+        os.remove(WAIT_JOB_FILEPATH)
     if os.path.exists(CRON_POLL_FILEPATH):
         os.remove(CRON_POLL_FILEPATH)
 
 
+def install_daemon():
+    """Installs and (re)starts the upstart job that runs the sync script
+    in daemon mode. The daemon schedules syncs itself and picks up
+    config changes, so no cron jobs are needed."""
+    install_sync_script()
+    shutil.copy(os.path.join('scripts', UPSTART_JOB_FILENAME), '/etc/init/')
+    service_restart(UPSTART_JOB_NAME)
+
+
+def uninstall_daemon():
+    "Stops and removes the upstart job"
+    if os.path.exists(UPSTART_JOB_FILEPATH):
+        service_stop(UPSTART_JOB_NAME)
+        os.remove(UPSTART_JOB_FILEPATH)
+
+
 @hooks.hook('identity-service-relation-joined')
 def identity_service_joined(relation_id=None):
     config = hookenv.config()
@@ -205,6 +255,25 @@ def config_changed():
 
     config = hookenv.config()
 
+    if config['daemon']:
+        if config.changed('daemon') or config.changed('run'):
+            hookenv.log("'daemon' or 'run' changed, removing cron jobs")
+            uninstall_cron_script()
+            uninstall_wait_job()
+
+            if not config['run']:
+                hookenv.log("'run' config now disabled, stopping daemon")
+                uninstall_daemon()
+            else:
+                hookenv.log("installing {}".format(UPSTART_JOB_FILEPATH))
+                install_daemon()
+        config.save()
+        return
+
+    if config.changed('daemon'):
+        hookenv.log("'daemon' disabled, removing upstart job")
+        uninstall_daemon()
+
     if config.changed('frequency'):
         hookenv.log("'frequency' changed, removing cron job")
         uninstall_cron_script()
@@ -213,18 +282,19 @@ def config_changed():
                         "/etc/cron.{}".format(config['frequency']))
             install_cron_script()
 
-    if config.changed('run'):
+    if config.changed('run') or config.changed('daemon'):
         hookenv.log("'run' changed, removing existing cron jobs")
         uninstall_cron_script()
-        uninstall_cron_poll()
+        uninstall_wait_job()
 
         if not config['run']:
             hookenv.log("'run' config now disabled, exiting")
         else:
             hookenv.log("'run' config now enabled, installing to "
                         "/etc/cron.{}".format(config['frequency']))
-            hookenv.log("installing {} for polling".format(CRON_POLL_FILEPATH))
-            install_cron_poll()
+            hookenv.log("installing {} to sync once glance is "
+                        "ready".format(WAIT_JOB_FILEPATH))
+            install_wait_job()
             install_cron_script()
     config.save()
 
@@ -233,6 +303,15 @@ def config_changed():
 def upgrade_charm():
     install()
     configs.write_all()
+    config = hookenv.config()
+    if config['daemon'] and config['run']:
+        install_daemon()
+
+
+@hooks.hook('stop')
+def stop():
+    uninstall_daemon()
+    uninstall_wait_job()
 
 
 @hooks.hook('amqp-relation-joined')
@@ -18,44 +18,189 @@
 # along with this charm.  If not, see <http://www.gnu.org/licenses/>.
 
 # This script runs as a cron job installed by the
-# glance-simplestreams-sync juju charm.  It reads config files that
+# glance-simplestreams-sync juju charm, or with --daemon as a
+# long-running upstart service.  It reads config files that
 # are written by the hooks of that charm based on its config and
 # juju relation to keystone. However, it does not execute in a
 # juju hook context itself.
 
+import atexit
+import datetime
+import json
 import logging
+import logging.handlers
+import Queue
+import threading
+import uuid
+
+LOG_FILE_NAME = '/var/log/glance-simplestreams-sync.log'
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# log records waiting for the writer thread; beyond this they are dropped
+LOG_QUEUE_SIZE = 10000
+
+# identifies the log records of one sync run
+log_context = {'run_id': uuid.uuid4().hex}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats log records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {'time': datetime.datetime.utcfromtimestamp(
+                     record.created).isoformat() + 'Z',
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'pid': record.process,
+                 'thread': record.threadName,
+                 'run_id': getattr(record, 'run_id', None),
+                 'message': record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        for key, value in entry.items():
+            if isinstance(value, str):
+                entry[key] = value.decode('utf-8', 'replace')
+        return json.dumps(entry, sort_keys=True)
+
+
+class QueueLogHandler(logging.Handler):
+    """Hands log records to a LogWriter thread instead of writing them.
+
+    Records are rendered to plain messages here, so they do not keep
+    references to objects the logging thread may still change. While
+    the queue is full, records are dropped and counted rather than
+    waited for.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            record.run_id = log_context['run_id']
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class LogWriter(object):
+    """Writes the records a QueueLogHandler queued with handler, from a
+    background thread."""
+
+    def __init__(self, queue, queue_handler, handler):
+        self.queue = queue
+        self.queue_handler = queue_handler
+        self.handler = handler
+        self.thread = threading.Thread(target=self.run, name="log-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            dropped, self.queue_handler.dropped = \
+                self.queue_handler.dropped, 0
+            if dropped:
+                self.handler.handle(logging.makeLogRecord(
+                    {'name': __name__, 'levelno': logging.WARNING,
+                     'levelname': 'WARNING', 'run_id': record.run_id,
+                     'msg': "log queue full, dropped {} log"
+                            " records".format(dropped)}))
+            self.handler.handle(record)
+
+    def stop(self, timeout=5):
+        """Writes the records queued so far, waiting at most timeout
+        seconds."""
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            return
+        self.thread.join(timeout)
 
 
 def setup_logging():
-    logfilename = '/var/log/glance-simplestreams-sync.log'
-    h = logging.FileHandler(logfilename)
-    h.setFormatter(logging.Formatter(
-        '%(levelname)-9s * %(asctime)s [PID:%(process)d] * %(name)s * '
-        '%(message)s',
-        datefmt='%m-%d %H:%M:%S'))
+    h = logging.handlers.RotatingFileHandler(LOG_FILE_NAME,
+                                             maxBytes=LOG_MAX_BYTES,
+                                             backupCount=LOG_BACKUP_COUNT,
+                                             delay=True)
+    h.setFormatter(JsonLogFormatter())
+
+    queue = Queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = QueueLogHandler(queue)
+    writer = LogWriter(queue, queue_handler, h)
+    atexit.register(writer.stop)
 
     logger = logging.getLogger()
     logger.setLevel('DEBUG')
-    logger.addHandler(h)
+    logger.addHandler(queue_handler)
 
     return logger
 
 log = setup_logging()
 
 
-import atexit
+def set_log_level(level):
+    """Sets the level of the root logger from the log_level option."""
+    try:
+        log.setLevel(str(level).upper())
+    except (ValueError, TypeError):
+        log.warning("invalid log_level {!r}, keeping {}".format(
+            level, logging.getLevelName(log.level)))
+
+
+def start_log_run():
+    """Starts a new run id for the log records that follow."""
+    log_context['run_id'] = uuid.uuid4().hex
+
+
+import argparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import contextlib
+import copy
+import collections
+import cProfile
+import errno
 import fcntl
 import glanceclient
+import hashlib
+from keystoneclient import access as keystone_access
 from keystoneclient.v2_0 import client as keystone_client
 import keystoneclient.exceptions as keystone_exceptions
 import kombu
 import os
-from simplestreams.mirrors import glance, UrlMirrorReader
-from simplestreams.objectstores.swift import SwiftObjectStore
-from simplestreams.util import read_signed, path_from_mirror_url
+import posixpath
+import pstats
+import re
+import shlex
+import signal
+from simplestreams import contentsource, openstack
+from simplestreams.mirrors import glance, MirrorReader, UrlMirrorReader
+from simplestreams.objectstores.swift import SwiftObjectStore, get_swiftclient
+from simplestreams.util import (get_local_copy, path_from_mirror_url,
+                                products_del, products_exdata, products_set,
+                                read_signed)
+import subprocess
+from swiftclient import client as swift_client
 import sys
+import tempfile
 import time
 import traceback
+import urllib2
+from urllib import quote
 from urlparse import urlsplit
 import yaml
 
@@ -67,6 +212,10 @@ ID_CONF_FILE_NAME = os.path.join(CONF_FILE_DIR, 'identity.yaml')
 
 SYNC_RUNNING_FLAG_FILE_NAME = os.path.join(PID_FILE_DIR,
                                            'glance-simplestreams-sync.pid')
+# left by an invocation that found a sync running, so that the running
+# sync starts another one when it is done
+RERUN_REQUEST_FILE_NAME = os.path.join(PID_FILE_DIR,
+                                       'glance-simplestreams-sync.rerun')
 
 # juju looks in simplestreams/data/* in swift to figure out which
 # images to deploy, so this path isn't really configurable even though
@@ -79,6 +228,103 @@ PRODUCT_STREAMS_SERVICE_DESC = 'Ubuntu Product Streams'
 
 CRON_POLL_FILENAME = '/etc/cron.d/glance_simplestreams_sync_fastpoll'
 
+REPORT_FILE_NAME = '/var/log/glance-simplestreams-sync-report.json'
+PROFILE_FILE_NAME = '/var/log/glance-simplestreams-sync.prof'
+
+CACHE_DIR = '/var/cache/glance-simplestreams-sync'
+METADATA_CACHE_DIR = os.path.join(CACHE_DIR, 'metadata')
+MIRROR_STATE_FILE_NAME = os.path.join(CACHE_DIR, 'mirror-state.json')
+METADATA_FETCH_TIMEOUT = 60
+SIGNATURE_CACHE_DIR = os.path.join(CACHE_DIR, 'signatures')
+SIGNATURE_CACHE_MAX_ENTRIES = 1024
+PARTIAL_DOWNLOAD_DIR = os.path.join(CACHE_DIR, 'partial')
+# partial downloads not resumed within this time are removed
+PARTIAL_DOWNLOAD_MAX_AGE = 7 * 24 * 60 * 60
+DOWNLOAD_READ_SIZE = 1024 * 1024
+DOWNLOAD_CHECKPOINT_BYTES = 64 * 1024 * 1024
+DOWNLOAD_TIMEOUT = 60
+# the hooks render this when no image-modifier is related
+NOOP_MODIFY_HOOKS = (None, '', '/bin/true')
+IMAGE_INDEX_FILE_NAME = os.path.join(CACHE_DIR, 'image-index.json')
+# how long the image index is trusted before it is rebuilt from glance
+IMAGE_INDEX_MAX_AGE = 24 * 60 * 60
+KEYSTONE_TOKEN_FILE_NAME = os.path.join(CACHE_DIR, 'keystone-token.json')
+PRODUCT_STREAMS_STATE_FILE_NAME = os.path.join(CACHE_DIR,
+                                               'product-streams.json')
+# objects written to swift in parallel, over as many connections
+SWIFT_WORKERS = 8
+# seconds to wait for a free swift connection before giving up, rather
+# than hanging a sync that holds the sync lock
+SWIFT_CONNECTION_TIMEOUT = 30 * 60
+# objects larger than this are uploaded as static large objects in
+# segments of this size; swift refuses single objects over 5 GiB
+SWIFT_SEGMENT_SIZE = 64 * 1024 * 1024
+# large objects are spooled here before their segments are uploaded
+SWIFT_SPOOL_DIR = os.path.join(CACHE_DIR, 'swift')
+SWIFT_READ_SIZE = 1024 * 1024
+# md5 of the whole content, which a large object's etag is not
+SWIFT_MD5_HEADER = 'x-object-meta-content-md5'
+# the simplestreams container is publicly readable, and so must be the
+# segments of its large objects, or anonymous clients get a 401 for them
+SWIFT_READ_ACL = '.r:*,.rlistings'
+
+# written to the metrics_textfile_dir option for node_exporter
+METRICS_FILE_NAME = 'glance_simplestreams_sync.prom'
+METRICS_STATE_FILE_NAME = os.path.join(CACHE_DIR, 'metrics-state.json')
+METRICS_PREFIX = 'glance_simplestreams_sync'
+# profiler phases that time calls to the glance, keystone and swift
+# APIs
+API_PHASES = {'keystone_auth': 'keystone',
+              'update_product_streams_service': 'keystone',
+              'glance_list_images': 'glance',
+              'glance_delete': 'glance',
+              'upload': 'glance',
+              'stream_upload': 'glance',
+              'swift_head': 'swift',
+              'swift_get': 'swift',
+              'swift_put': 'swift',
+              'swift_delete': 'swift'}
+# profiler counts reported as errors of the last run
+ERROR_COUNTS = ('sync_failed', 'mirror_failed', 'status_lost')
+# cached keystone tokens are renewed this many seconds before they expire,
+# or once this fraction of their lifetime is used up, whichever comes
+# first: the glance and swift clients keep the token they were built
+# with for a whole mirror sync, which can take hours
+KEYSTONE_TOKEN_MIN_LIFETIME = 10 * 60
+KEYSTONE_TOKEN_MAX_USED = 0.1
+
+# seconds between syncs in daemon mode, by the charm's frequency option
+DAEMON_INTERVALS = {'hourly': 60 * 60,
+                    'daily': 24 * 60 * 60,
+                    'weekly': 7 * 24 * 60 * 60}
+# while glance is not ready, its endpoint is looked up again after
+# READINESS_INITIAL_DELAY seconds, doubling up to READINESS_MAX_DELAY
+READINESS_INITIAL_DELAY = 10
+READINESS_MAX_DELAY = 10 * 60
+# how often an idle daemon checks its config files for changes
+DAEMON_CONF_POLL_INTERVAL = 60
+
+# status messages waiting for the publisher thread; beyond this, the
+# oldest progress messages are dropped
+STATUS_QUEUE_SIZE = 100
+# minimum seconds between published progress messages of one image
+STATUS_MIN_INTERVAL = 1.0
+# how long close() waits for queued status messages to be published
+STATUS_FLUSH_TIMEOUT = 10
+# seconds to wait for each rabbitmq host to accept a connection
+STATUS_CONNECT_TIMEOUT = 3
+# after this many failed connection attempts in a row, no connection is
+# attempted for STATUS_BREAKER_COOLDOWN seconds
+STATUS_BREAKER_FAILURES = 3
+STATUS_BREAKER_COOLDOWN = 60
+# status messages that could not be published, replayed on reconnect
+STATUS_SPOOL_FILE_NAME = os.path.join(CACHE_DIR, 'status-spool.jsonl')
+STATUS_SPOOL_FSYNC_INTERVAL = 1.0
+STATUS_SPOOL_MAX_BYTES = 16 * 1024 * 1024
+# defaults of the progress_min_interval and progress_min_percent options
+PROGRESS_MIN_INTERVAL = 1.0
+PROGRESS_MIN_PERCENT = 1
+
 # TODOs:
 #   - allow people to specify their own policy, since they can specify
 #     their own mirrors.
@@ -97,60 +343,1988 @@ except ImportError:
 
 
 class StatusMessageProgressAggregator(ProgressAggregator):
-    def __init__(self, remaining_items, send_status_message):
+    """Turns simplestreams progress callbacks into status messages.
+
+    Several images may be downloading at the same time, so progress
+    is tracked per image name rather than by assuming that one image
+    finishes before the next one starts.
+
+    A progress message for an image is only emitted once the image has
+    advanced by min_percent percent and min_interval seconds have passed
+    since its last message; either threshold is ignored if it is 0. The
+    message for a finished image is always emitted.
+    """
+
+    def __init__(self, remaining_items, send_status_message,
+                 min_interval=PROGRESS_MIN_INTERVAL,
+                 min_percent=PROGRESS_MIN_PERCENT):
         super(StatusMessageProgressAggregator, self).__init__(remaining_items)
         self.send_status_message = send_status_message
+        self.min_interval = float(min_interval)
+        self.min_percent = float(min_percent)
+        self.lock = threading.Lock()
+        self.image_written = {}
+        # name -> (bytes written, time) when it was last emitted
+        self.image_emitted = {}
+        self.images_finished = set()
+
+    def progress_callback(self, progress):
+        with self.lock:
+            name = progress['name']
+            size = float(progress['size'])
+            written = self.image_written.get(name, 0) + progress['written']
+            self.image_written[name] = written
+            self.total_written += progress['written']
+
+            if name in self.images_finished:
+                return
+            if size and written >= size:
+                self.images_finished.add(name)
+                self.remaining_items.pop(name, None)
+            elif not self.should_emit(name, written, size):
+                return
+            self.image_emitted[name] = (written, time.time())
+            self.emit(dict(progress, written=written))
+
+    def should_emit(self, name, written, size):
+        last_written, last_time = self.image_emitted.get(name, (0, 0))
+        if self.min_percent and \
+                (written - last_written) * 100 < self.min_percent * size:
+            return False
+        if self.min_interval and \
+                time.time() - last_time < self.min_interval:
+            return False
+        return True
 
     def emit(self, progress):
-        size = float(progress['size'])
+        size = float(progress['size']) or 1.0
         written = float(progress['written'])
-        cur = self.total_image_count - len(self.remaining_items) + 1
-        totpct = float(self.total_written) / self.total_size
+        cur = min(len(self.images_finished) + 1, self.total_image_count)
+        totpct = float(self.total_written) / (self.total_size or 1)
         msg = "{name} {filepct:.0%}\n"\
               "({cur} of {tot} images) total: "\
               "{totpct:.0%}".format(name=progress['name'],
-                                    filepct=(written / size),
+                                    filepct=min(written / size, 1.0),
                                     cur=cur,
                                     tot=self.total_image_count,
-                                    totpct=totpct)
+                                    totpct=min(totpct, 1.0))
         self.send_status_message(dict(status="Syncing",
-                                      message=msg))
+                                      message=msg),
+                                 key=progress['name'])
+
+
+class Phase(object):
+    """Handle for a running SyncProfiler.phase(); set .bytes to record
+    the amount of data the phase moved."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.seconds = 0.0
+
+
+class SyncProfiler(object):
+    """Records wall time, bytes and counts per phase and per mirror of a
+    sync run, and per synced item.
+
+    Phases are attributed to the mirror bound to the current thread with
+    bind_mirror(); threads started through start_thread() inherit the
+    mirror of the thread that started them. If cProfile profiling is
+    enabled, every such thread is profiled too and the results are
+    merged into one dump.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self, profile=False):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.totals = {}
+        self.mirrors = {}
+        self.items = []
+        self.profiles = []
+        self.profile = profile
+        if profile:
+            prof = cProfile.Profile()
+            prof.enable()
+            self.profiles.append(prof)
+
+    def bind_mirror(self, mirror):
+        self.local.mirror = mirror
+
+    def current_mirror(self):
+        return getattr(self.local, 'mirror', None)
+
+    def _add(self, stats, name, seconds, nbytes, count):
+        entry = stats.setdefault(name, {'count': 0, 'seconds': 0.0,
+                                        'bytes': 0})
+        entry['count'] += count
+        entry['seconds'] += seconds
+        entry['bytes'] += nbytes
+
+    def record(self, name, seconds=0.0, nbytes=0, count=1):
+        mirror = self.current_mirror()
+        with self.lock:
+            self._add(self.totals, name, seconds, nbytes, count)
+            if mirror is not None:
+                self._add(self.mirrors.setdefault(mirror, {}), name,
+                          seconds, nbytes, count)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        phase = Phase()
+        start = time.time()
+        try:
+            yield phase
+        finally:
+            phase.seconds = time.time() - start
+            self.record(name, phase.seconds, phase.bytes)
+
+    def record_item(self, **fields):
+        fields['mirror'] = self.current_mirror()
+        with self.lock:
+            self.items.append(fields)
+
+    def start_thread(self, target, name):
+        mirror = self.current_mirror()
+
+        def run():
+            self.bind_mirror(mirror)
+            if not self.profile:
+                return target()
+            prof = cProfile.Profile()
+            try:
+                return prof.runcall(target)
+            finally:
+                with self.lock:
+                    self.profiles.append(prof)
+
+        t = threading.Thread(target=run, name=name)
+        t.daemon = True
+        t.start()
+        return t
+
+    def report(self):
+        with self.lock:
+            return {'run_id': log_context['run_id'],
+                    'started': self.started,
+                    'finished': time.time(),
+                    'seconds': time.time() - self.started,
+                    'phases': copy.deepcopy(self.totals),
+                    'mirrors': copy.deepcopy(self.mirrors),
+                    'items': list(self.items)}
+
+    def write_report(self, filename=None):
+        atomic_write(filename or REPORT_FILE_NAME,
+                     json.dumps(self.report(), indent=1, sort_keys=True))
+
+    def write_profile(self, filename=None):
+        """Writes the merged cProfile data of all profiled threads, the
+        one that called reset() included."""
+        with self.lock:
+            profiles = list(self.profiles)
+        if profiles:
+            profiles[0].disable()
+            stats = pstats.Stats(*profiles)
+            stats.dump_stats(filename or PROFILE_FILE_NAME)
+
+    def finish(self):
+        try:
+            self.write_report()
+            if self.profile:
+                self.write_profile()
+        except:
+            log.exception("Exception writing sync report")
+
+
+profiler = SyncProfiler()
+
+
+def to_bytes(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+class SignatureCache(object):
+    """Remembers the payloads of signed documents that gpg has already
+    verified against the current keyring.
+
+    Entries are keyed by a digest of the keyring and the signed content,
+    so a changed keyring never matches an entry verified with the old
+    one; the first lookup after such a change clears the cache, even in
+    the middle of a run. Only max_entries entries are kept, least
+    recently used ones are evicted first. The cache directory is
+    root-only, since an entry is as good as a valid signature.
+    """
+
+    def __init__(self, cache_dir, keyring, max_entries):
+        self.cache_dir = cache_dir
+        self.keyring = keyring
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self._keyring_id = None
+        self._keyring_stamp = None
+
+    def keyring_id(self):
+        # the keyring is re-stat'ed on every lookup, since it can be
+        # replaced while a long sync is running
+        with self.lock:
+            st = os.stat(self.keyring)
+            stamp = (st.st_mtime, st.st_size, st.st_ino)
+            if stamp != self._keyring_stamp:
+                with open(self.keyring, 'rb') as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+                self._keyring_id = "{}-{}".format(digest, st.st_mtime)
+                self._keyring_stamp = stamp
+                self._check_keyring(self._keyring_id)
+            return self._keyring_id
+
+    def _check_keyring(self, keyring_id):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, 0o700)
+        marker = os.path.join(self.cache_dir, 'keyring')
+        try:
+            with open(marker) as f:
+                if f.read() == keyring_id:
+                    return
+        except IOError:
+            pass
+        log.info("{} changed, clearing {}".format(self.keyring,
+                                                   self.cache_dir))
+        for name in os.listdir(self.cache_dir):
+            os.unlink(os.path.join(self.cache_dir, name))
+        atomic_write(marker, keyring_id, mode=0o600)
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.payload'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    entries.append((os.stat(path).st_mtime, path))
+                except OSError:
+                    pass
+        entries.sort()
+        for mtime, path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def read_signed(self, content):
+        key = hashlib.sha256(self.keyring_id())
+        key.update(to_bytes(content))
+        entry = os.path.join(self.cache_dir, key.hexdigest() + '.payload')
+        try:
+            with open(entry, 'rb') as f:
+                payload = f.read().decode('utf-8')
+            os.utime(entry, None)
+            profiler.record('gpg_cache_hit')
+            return payload
+        except (IOError, OSError):
+            pass
+
+        with profiler.phase('gpg_verify'):
+            payload = read_signed(content, keyring=self.keyring)
+        atomic_write(entry, to_bytes(payload), mode=0o600)
+        self._evict()
+        return payload
+
+
+signature_cache = SignatureCache(SIGNATURE_CACHE_DIR, KEYRING,
+                                 SIGNATURE_CACHE_MAX_ENTRIES)
 
 
 def policy(content, path):
     if path.endswith('sjson'):
-        return read_signed(content, keyring=KEYRING)
+        return signature_cache.read_signed(content)
     else:
         return content
 
 
+def atomic_write(filename, content, mode=0o644):
+    """Replaces filename with content, so readers never see a partial
+    file."""
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmpname = tempfile.mkstemp(dir=dirname,
+                                   prefix=".{}.".format(
+                                       os.path.basename(filename)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmpname, mode)
+        os.rename(tmpname, filename)
+    except:
+        os.unlink(tmpname)
+        raise
+
+
+class StateFile(object):
+    """A JSON dict kept on local disk between runs.
+
+    A missing or unreadable file is treated as empty, so losing it only
+    costs the work it was saving.
+    """
+
+    def __init__(self, filename, mode=0o644):
+        self.filename = filename
+        self.mode = mode
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save(self, state):
+        atomic_write(self.filename, json.dumps(state), mode=self.mode)
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.load().get(key, default)
+
+    def set(self, key, value):
+        self.modify(key, lambda old: value)
+
+    def modify(self, key, func):
+        """Replaces the value of key with func(old value), or removes key
+        if func returns None."""
+        with self.lock:
+            state = self.load()
+            value = func(state.get(key))
+            if value is None:
+                state.pop(key, None)
+            else:
+                state[key] = value
+            self.save(state)
+
+
+class ImageIndex(object):
+    """Local record of the images synced into glance, per content_id.
+
+    Each entry is a table of (product, version, item, item data) rows
+    matching the target tree GlanceMirror.load_products() builds from
+    glance, so a sync can diff upstream against it without listing
+    every image in glance. An entry is rebuilt from glance once it is
+    older than max_age, and while a sync that changes it is running:
+    a sync that fails or is killed leaves the marker it set in begin()
+    behind, so nothing it may have uploaded is missed. Markers record
+    the pid and process start time of their sync, and replace() drops
+    those of syncs that are no longer running, so the rebuilt entry is
+    used again.
+    """
+
+    def __init__(self, filename, max_age):
+        self.state = StateFile(filename, mode=0o600)
+        self.max_age = max_age
+
+    def products(self, content_id, token=None):
+        """Returns the indexed target tree for content_id, or None if
+        it has to be loaded from glance. token is the caller's own
+        marker from begin(), if any."""
+        entry = self.state.get(content_id)
+        if not entry or self._tokens(entry['syncing']) - set([token]) or \
+                time.time() - entry['reconciled_at'] > self.max_age:
+            return None
+        target = glance.empty_iid_products(content_id)
+        for product, version, item, data in entry['rows']:
+            products_set(target, data, (product, version, item))
+        return target
+
+    def replace(self, content_id, target):
+        rows = []
+        for pname, product in target.get('products', {}).items():
+            for vname, version in product.get('versions', {}).items():
+                for iname, item in version.get('items', {}).items():
+                    rows.append((pname, vname, iname, item))
+
+        def replace_rows(entry):
+            return {'reconciled_at': time.time(), 'rows': rows,
+                    'syncing': self._running(entry['syncing'])
+                    if entry else []}
+        self.state.modify(content_id, replace_rows)
+
+    @staticmethod
+    def _tokens(markers):
+        # markers written before they recorded their process were
+        # plain tokens
+        return set(m['token'] if isinstance(m, dict) else m
+                   for m in markers)
+
+    @staticmethod
+    def _running(markers):
+        """Returns the markers of syncs whose process still runs."""
+        return [m for m in markers if isinstance(m, dict) and
+                process_start_time(m['pid']) == m['process_start_time']]
+
+    def begin(self, content_id):
+        """Marks the entry for content_id as being changed, returning a
+        token for products() and end()."""
+        pid = os.getpid()
+        marker = {'token': uuid.uuid4().hex, 'pid': pid,
+                  'process_start_time': process_start_time(pid)}
+
+        def mark(entry):
+            if entry:
+                entry['syncing'].append(marker)
+            return entry
+        self.state.modify(content_id, mark)
+        return marker['token']
+
+    def record(self, content_id, added, removed):
+        """Adds the (pedigree, item) pairs in added to the entry for
+        content_id and drops the pedigrees in removed."""
+        def update(entry):
+            if not entry:
+                return None
+            rows = dict((tuple(row[:3]), row[3]) for row in entry['rows'])
+            for pedigree in removed:
+                rows.pop(tuple(pedigree), None)
+            for pedigree, item in added:
+                rows[tuple(pedigree)] = item
+            entry['rows'] = [key + (item,) for key, item in rows.items()]
+            return entry
+        self.state.modify(content_id, update)
+
+    def end(self, content_id, token):
+        def unmark(entry):
+            if entry:
+                entry['syncing'] = [m for m in entry['syncing']
+                                    if self._tokens([m]) != set([token])]
+            return entry
+        self.state.modify(content_id, unmark)
+
+    def abort(self, content_id):
+        self.state.modify(content_id, lambda entry: None)
+
+
+image_index = ImageIndex(IMAGE_INDEX_FILE_NAME, IMAGE_INDEX_MAX_AGE)
+
+
+class ImageIndexMixin(object):
+    """Makes a GlanceMirror load its target tree from image_index, and
+    refresh the index whenever it has to ask glance instead."""
+
+    def load_products(self, path=None, content_id=None):
+        my_cid = self.config['content_id']
+        target = image_index.products(my_cid,
+                                      getattr(self, 'index_token', None))
+        if target is not None:
+            log.info("using local image index for {}".format(my_cid))
+            for product in target['products'].values():
+                product['region'] = self.region
+                product['endpoint'] = self.auth_url
+            return target
+
+        log.info("loading image list for {} from glance".format(my_cid))
+        with profiler.phase('glance_list_images'):
+            target = super(ImageIndexMixin, self).load_products(path,
+                                                                content_id)
+        image_index.replace(my_cid, target)
+        return target
+
+
+class ItemMatcherMixin(object):
+    """Makes a GlanceMirror filter items with the ItemMatcher it was
+    given, which is shared by the planning and the real mirror of a
+    sync."""
+
+    item_matcher = None
+
+    def filter_item(self, data, src, target, pedigree):
+        if self.item_matcher is None:
+            return super(ItemMatcherMixin, self).filter_item(
+                data, src, target, pedigree)
+        return self.item_matcher.matches(src, pedigree)
+
+
+class CachingUrlMirrorReader(UrlMirrorReader):
+    """UrlMirrorReader that revalidates metadata documents against an
+    on-disk cache with conditional GETs.
+
+    Each cached document keeps the ETag and Last-Modified headers it
+    was served with, and unchanged documents are answered by a 304
+    instead of a full download. Image payloads still go through
+    source() and are not cached.
+    """
+
+    def __init__(self, prefix, policy, cache_dir=None):
+        super(CachingUrlMirrorReader, self).__init__(prefix, policy=policy)
+        self.cache_dir = cache_dir or METADATA_CACHE_DIR
+        self.fetched = {}
+        self.paths_read = []
+
+    def _cache_file(self, url):
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(url).hexdigest() + '.json')
+
+    def fetch(self, path):
+        """Returns (content, changed) for path, where changed is False
+        if the server confirmed the cached copy is current."""
+        if path in self.fetched:
+            return self.fetched[path]
+
+        url = self.prefix + path
+        cache_file = self._cache_file(url)
+        cached = StateFile(cache_file).load()
+
+        request = urllib2.Request(url)
+        if cached.get('etag'):
+            request.add_header('If-None-Match', cached['etag'])
+        if cached.get('last_modified'):
+            request.add_header('If-Modified-Since', cached['last_modified'])
+
+        with profiler.phase('metadata_fetch') as phase:
+            try:
+                response = urllib2.urlopen(request,
+                                           timeout=METADATA_FETCH_TIMEOUT)
+            except urllib2.HTTPError as e:
+                if e.code != 304 or 'content' not in cached:
+                    raise
+                log.debug("{} not modified, using cached copy".format(url))
+                profiler.record('metadata_not_modified')
+                self.fetched[path] = (cached['content'], False)
+                return self.fetched[path]
+
+            raw = response.read()
+            phase.bytes = len(raw)
+        content = raw.decode('utf-8')
+        headers = response.info()
+        StateFile(cache_file).save(
+            {'url': url,
+             'etag': headers.getheader('ETag'),
+             'last_modified': headers.getheader('Last-Modified'),
+             'content': content})
+        self.fetched[path] = (content, True)
+        return self.fetched[path]
+
+    def read_json(self, path):
+        raw, changed = self.fetch(path)
+        self.paths_read.append(path)
+        return raw, self.policy(content=raw, path=path)
+
+    def unchanged(self, paths):
+        """Returns True if every document in paths is still current."""
+        for path in paths:
+            if self.fetch(path)[1]:
+                log.info("{}{} has changed".format(self.prefix, path))
+                return False
+        return True
+
+
+class MemoizingMirrorReader(MirrorReader):
+    """Wraps a MirrorReader so each metadata document is fetched and
+    verified only once.
+
+    The DryRun planning pass and the real sync walk the same index and
+    products files; with this wrapper the second walk is served from
+    memory instead of repeating the download and the gpg check.
+    """
+
+    def __init__(self, reader):
+        super(MemoizingMirrorReader, self).__init__(policy=reader.policy)
+        self.reader = reader
+        self.documents = {}
+
+    def source(self, path):
+        return self.reader.source(path)
+
+    def read_json(self, path):
+        if path not in self.documents:
+            self.documents[path] = self.reader.read_json(path)
+        return self.documents[path]
+
+
+class PlanningDryRunMirror(ItemMatcherMixin, ImageIndexMixin,
+                           glance.ItemInfoDryRunMirror):
+    """ItemInfoDryRunMirror that hands the glance state it loads on to
+    the mirror doing the real sync, through planned_targets."""
+
+    def __init__(self, config, objectstore, planned_targets,
+                 item_matcher=None):
+        super(PlanningDryRunMirror, self).__init__(config=config,
+                                                   objectstore=objectstore)
+        self.planned_targets = planned_targets
+        self.item_matcher = item_matcher
+
+    def load_products(self, path=None, content_id=None):
+        target = super(PlanningDryRunMirror, self).load_products(
+            path, content_id)
+        self.planned_targets[path] = copy.deepcopy(target)
+        return target
+
+
+class ImageChecksums(object):
+    """Size, sha256 and md5 of an image, computed as it streams past."""
+
+    def __init__(self):
+        self.size = 0
+        self.hashers = {'sha256': hashlib.sha256(), 'md5': hashlib.md5()}
+
+    def update(self, buf):
+        self.size += len(buf)
+        for hasher in self.hashers.values():
+            hasher.update(buf)
+
+    def hexdigest(self, name):
+        return self.hashers[name].hexdigest()
+
+    def verify(self, url, size=None, sha256=None, md5=None):
+        """Raises IOError unless every expected value given matches."""
+        if size is not None and self.size != int(size):
+            raise IOError("{}: expected {} bytes, got {}".format(
+                url, size, self.size))
+        for name, expected in (('sha256', sha256), ('md5', md5)):
+            if expected and self.hexdigest(name) != expected:
+                raise IOError("{}: {} mismatch, expected {}, got {}".format(
+                    url, name, expected, self.hexdigest(name)))
+
+
+def read_chunks(fileobj, read_size=DOWNLOAD_READ_SIZE):
+    while True:
+        buf = fileobj.read(read_size)
+        if not buf:
+            return
+        yield buf
+
+
+def hashed_chunks(chunks, checksums):
+    for buf in chunks:
+        checksums.update(buf)
+        yield buf
+
+
+def reported_chunks(chunks, progress_callback):
+    for buf in chunks:
+        if progress_callback:
+            progress_callback(len(buf))
+        yield buf
+
+
+class ChunkReader(object):
+    """File-like object reading from an iterator of chunks, for clients
+    that want to read() their request body."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buf = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            try:
+                self.buf += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+
+class ResumableDownload(object):
+    """Downloads url into a file under download_dir that survives the
+    sync being interrupted.
+
+    Every checkpoint_bytes the file is synced to disk and a state file
+    records the offset reached, the sha256 of the data up to there and
+    the ETag/Last-Modified of the response. A later download of the
+    same url re-hashes the partial file locally and, if it matches the
+    checkpoint, asks the server for the rest with a Range request.
+    If-Range makes the server send the whole file instead if it has
+    changed in the meantime. The file is kept until discard() is
+    called, so a download whose upload failed is not fetched again.
+
+    The data is checksummed while it is written, and the result is
+    left in self.checksums, so nothing needs to read the file again to
+    verify it.
+
+    fetch() holds an flock on a lock file next to the partial file, so
+    concurrent downloads of one url, e.g. by mirrors whose filters
+    overlap on the same upstream, do not write the same file: the
+    second one waits and then reuses the finished download.
+    """
+
+    def __init__(self, url, size=None, sha256=None, md5=None,
+                 progress_callback=None, download_dir=None,
+                 checkpoint_bytes=DOWNLOAD_CHECKPOINT_BYTES):
+        self.url = url
+        self.size = size
+        self.sha256 = sha256
+        self.md5 = md5
+        self.progress_callback = progress_callback
+        self.checkpoint_bytes = checkpoint_bytes
+        self.checksums = None
+        download_dir = download_dir or PARTIAL_DOWNLOAD_DIR
+        key = hashlib.sha256(to_bytes(url)).hexdigest()
+        self.path = os.path.join(download_dir, key + '.part')
+        self.lock_path = os.path.join(download_dir, key + '.lock')
+        self.state = StateFile(os.path.join(download_dir, key + '.state'),
+                               mode=0o600)
+        if not os.path.isdir(download_dir):
+            os.makedirs(download_dir, 0o700)
+
+    @staticmethod
+    def expire(download_dir=None, max_age=PARTIAL_DOWNLOAD_MAX_AGE):
+        """Removes partial downloads that have not been touched for
+        max_age seconds."""
+        download_dir = download_dir or PARTIAL_DOWNLOAD_DIR
+        if not os.path.isdir(download_dir):
+            return
+        for name in os.listdir(download_dir):
+            path = os.path.join(download_dir, name)
+            try:
+                if time.time() - os.stat(path).st_mtime > max_age:
+                    log.info("removing stale partial download "
+                             "{}".format(path))
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    def _resume_point(self, state):
+        """Returns the ImageChecksums of the part of the file that can be
+        kept, after checking it against the checkpoint in state."""
+        offset = state.get('offset', 0)
+        if state.get('url') != self.url or not offset or \
+                not os.path.exists(self.path) or \
+                os.path.getsize(self.path) < offset:
+            return ImageChecksums()
+
+        checksums = ImageChecksums()
+        with open(self.path, 'rb') as f:
+            for buf in read_chunks(f):
+                checksums.update(buf[:offset - checksums.size])
+                if checksums.size >= offset:
+                    break
+        if checksums.size != offset or \
+                checksums.hexdigest('sha256') != state.get('sha256'):
+            log.warning("partial download of {} does not match its "
+                        "checkpoint, starting over".format(self.url))
+            return ImageChecksums()
+        return checksums
+
+    def _checkpoint(self, checksums, validators, complete=False):
+        state = dict(validators, url=self.url, offset=checksums.size,
+                     sha256=checksums.hexdigest('sha256'),
+                     complete=complete)
+        self.state.save(state)
+
+    def _open(self, offset, state):
+        request = urllib2.Request(self.url)
+        if offset:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+            validator = state.get('etag') or state.get('last_modified')
+            if validator:
+                request.add_header('If-Range', validator)
+        return urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+
+    def _verify(self, checksums):
+        checksums.verify(self.url, size=self.size, sha256=self.sha256,
+                         md5=self.md5)
+
+    def _matches(self, checksums):
+        try:
+            self._verify(checksums)
+        except IOError:
+            return False
+        return True
+
+    def fetch(self):
+        """Downloads the rest of url and returns the local file name."""
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            return self._fetch()
+
+    def _fetch(self):
+        state = self.state.load()
+        checksums = self._resume_point(state)
+
+        if state.get('complete'):
+            if checksums.size and self._matches(checksums):
+                log.info("{} was already downloaded".format(self.url))
+                if self.progress_callback:
+                    self.progress_callback(checksums.size)
+                self.checksums = checksums
+                return self.path
+            checksums = ImageChecksums()
+
+        try:
+            response = self._open(checksums.size, state)
+        except urllib2.HTTPError as e:
+            if e.code != 416 or not checksums.size:
+                raise
+            log.info("server refused to resume {}, "
+                     "starting over".format(self.url))
+            checksums = ImageChecksums()
+            response = self._open(0, state)
+
+        if checksums.size and response.getcode() != 206:
+            log.info("{} changed upstream, starting over".format(self.url))
+            checksums = ImageChecksums()
+        elif checksums.size:
+            log.info("resuming {} at byte {}".format(self.url,
+                                                     checksums.size))
+
+        headers = response.info()
+        validators = {'etag': headers.getheader('ETag'),
+                      'last_modified': headers.getheader('Last-Modified')}
+
+        if checksums.size and self.progress_callback:
+            self.progress_callback(checksums.size)
+        chunks = reported_chunks(hashed_chunks(read_chunks(response),
+                                               checksums),
+                                 self.progress_callback)
+        with open(self.path, 'r+b' if checksums.size else 'wb') as f:
+            f.seek(checksums.size)
+            f.truncate()
+            last_checkpoint = checksums.size
+            try:
+                for buf in chunks:
+                    f.write(buf)
+                    if checksums.size - last_checkpoint >= \
+                            self.checkpoint_bytes:
+                        f.flush()
+                        os.fsync(f.fileno())
+                        self._checkpoint(checksums, validators)
+                        last_checkpoint = checksums.size
+            except Exception:
+                # e.g. a timeout; keep what arrived for the next run
+                f.flush()
+                os.fsync(f.fileno())
+                self._checkpoint(checksums, validators)
+                raise
+            f.flush()
+            os.fsync(f.fileno())
+
+        if self.size is not None and checksums.size < int(self.size):
+            # httplib returns a short body without an error when the
+            # connection drops, so resume instead of starting over
+            self._checkpoint(checksums, validators)
+            raise IOError("download of {} ended after {} of {} bytes, "
+                          "will resume".format(self.url, checksums.size,
+                                               self.size))
+
+        try:
+            self._verify(checksums)
+        except IOError:
+            self.discard()
+            raise
+
+        self._checkpoint(checksums, validators, complete=True)
+        self.checksums = checksums
+        return self.path
+
+    def discard(self):
+        for path in (self.path, self.state.filename):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def content_url(contentsource):
+    """Returns the URL a simplestreams content source reads from, looking
+    through checksumming wrappers."""
+    while contentsource is not None:
+        url = getattr(contentsource, 'url', None)
+        if url:
+            return url
+        contentsource = getattr(contentsource, 'cs', None)
+    return None
+
+
+class ImageTransfer(object):
+    """An item on its way from a mirror into glance."""
+
+    def __init__(self, data, src, target, pedigree, contentsource, t_item):
+        self.data = data
+        self.src = src
+        self.target = target
+        self.pedigree = pedigree
+        self.contentsource = contentsource
+        self.t_item = t_item
+        self.path = None
+        self.delete_path = False
+        self.download = None
+        self.uploaded = False
+        self.checksums = None
+        self.stream_url = None
+        self.progress_callback = None
+        self.download_seconds = 0.0
+
+    def cleanup(self):
+        """Removes the local copy of the image, unless it is a resumable
+        download that has not made it into glance yet."""
+        if self.delete_path and self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+        if self.download is not None and self.uploaded:
+            self.download.discard()
+        self.path = None
+
+
+class ImageTransferPipeline(object):
+    """Runs downloads and uploads of ImageTransfers in two thread pools.
+
+    put() blocks while all downloaders are busy, and downloaders block
+    while queue_size downloaded images are waiting for an uploader, so
+    at most downloaders + queue_size + uploaders images are held on
+    disk at once. After the first failure, or after abort(), transfers
+    still queued are discarded and wait() re-raises that failure.
+    """
+
+    def __init__(self, download, upload, downloaders=1, uploaders=1,
+                 queue_size=1):
+        self.download = download
+        self.upload = upload
+        self.ndownloaders = max(1, downloaders)
+        self.nuploaders = max(1, uploaders)
+        self.downloads = Queue.Queue(maxsize=self.ndownloaders)
+        self.uploads = Queue.Queue(maxsize=max(1, queue_size))
+        self.failures = []
+        self.threads = []
+
+    def _start(self):
+        for n in range(self.ndownloaders):
+            self._start_worker(self._download_worker,
+                               "download-{}".format(n))
+        for n in range(self.nuploaders):
+            self._start_worker(self._upload_worker, "upload-{}".format(n))
+
+    def _start_worker(self, target, name):
+        self.threads.append(profiler.start_thread(
+            target, "{}-{}".format(threading.current_thread().name, name)))
+
+    def _run_stage(self, queue, stage, next_queue):
+        while True:
+            transfer = queue.get()
+            try:
+                if transfer is None:
+                    return
+                if self.failures:
+                    transfer.cleanup()
+                    continue
+                stage(transfer)
+                if next_queue is not None:
+                    next_queue.put(transfer)
+                else:
+                    transfer.cleanup()
+            except Exception:
+                log.exception("Exception during image transfer of "
+                              "{}".format("/".join(transfer.pedigree)))
+                self.failures.append(sys.exc_info())
+                transfer.cleanup()
+            finally:
+                queue.task_done()
+
+    def _download_worker(self):
+        self._run_stage(self.downloads, self.download, self.uploads)
+
+    def _upload_worker(self):
+        self._run_stage(self.uploads, self.upload, None)
+
+    def put(self, transfer):
+        if not self.threads:
+            self._start()
+        self.downloads.put(transfer)
+
+    def wait(self):
+        """Blocks until every transfer put so far has been uploaded or
+        discarded."""
+        self.downloads.join()
+        self.uploads.join()
+        if self.failures:
+            exc_type, exc_value, exc_tb = self.failures[0]
+            raise exc_type, exc_value, exc_tb
+
+    def abort(self, exc_info):
+        """Records a failure of the caller, so that transfers still
+        queued are cleaned up by close() instead of uploaded."""
+        self.failures.append(exc_info)
+
+    def close(self):
+        if not self.threads:
+            return
+        for n in range(self.ndownloaders):
+            self.downloads.put(None)
+        self.downloads.join()
+        for n in range(self.nuploaders):
+            self.uploads.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+
+class PipelinedGlanceMirror(ItemMatcherMixin, ImageIndexMixin,
+                            glance.GlanceMirror):
+    """GlanceMirror that overlaps image downloads with glance uploads.
+
+    insert_item() only queues the item on an ImageTransferPipeline.
+    The item is added to the target tree right away so that max_items
+    pruning in sync_products() accounts for it, but the image removals
+    that pruning asks for are held back until every queued upload has
+    succeeded. insert_products() waits for the pipeline before any
+    metadata is written, and then records the changes in image_index.
+    """
+
+    def __init__(self, config, objectstore=None, name_prefix=None,
+                 progress_callback=None, downloaders=1, uploaders=1,
+                 queue_size=1, planned_targets=None, stream_uploads=False,
+                 item_matcher=None):
+        kwargs = dict(objectstore=objectstore, name_prefix=name_prefix)
+        if progress_callback is not None:
+            kwargs['progress_callback'] = progress_callback
+        super(PipelinedGlanceMirror, self).__init__(config, **kwargs)
+        self.image_progress_callback = progress_callback
+        self.image_name_prefix = name_prefix or ""
+        self.pipeline = ImageTransferPipeline(self.download_item,
+                                              self.upload_item,
+                                              downloaders=downloaders,
+                                              uploaders=uploaders,
+                                              queue_size=queue_size)
+        self.deferred_removals = []
+        self.planned_targets = planned_targets or {}
+        self.index_added = []
+        self.index_token = None
+        self.stream_uploads = stream_uploads
+        self.item_matcher = item_matcher
+
+    def sync(self, reader, path):
+        content_id = self.config['content_id']
+        self.index_token = image_index.begin(content_id)
+        try:
+            ret = super(PipelinedGlanceMirror, self).sync(reader, path)
+        except:
+            self.pipeline.abort(sys.exc_info())
+            image_index.abort(content_id)
+            raise
+        finally:
+            self.pipeline.close()
+        image_index.end(content_id, self.index_token)
+        return ret
+
+    def image_name(self, flat):
+        name = "{}{}".format(self.image_name_prefix,
+                             flat.get('pubname', flat.get('name')))
+        if not name.endswith(flat['item_name']):
+            name += "-{}".format(flat['item_name'])
+        return name
+
+    def load_products(self, path=None, content_id=None):
+        if path in self.planned_targets:
+            return self.planned_targets.pop(path)
+        return super(PipelinedGlanceMirror, self).load_products(path,
+                                                                content_id)
+
+    def insert_item(self, data, src, target, pedigree, contentsource):
+        flat = products_exdata(src, pedigree, include_top=False)
+        t_item = flat.copy()
+        if 'path' in t_item:
+            del t_item['path']
+        for n in ('product_name', 'version_name', 'item_name'):
+            t_item.pop(n, None)
+        t_item['name'] = self.image_name(flat)
+        t_item['region'] = self.region
+        t_item['endpoint'] = self.auth_url
+        t_item['owner_id'] = self.tenant_id
+        products_set(target, t_item, pedigree)
+        self.index_added.append((pedigree, t_item))
+
+        self.pipeline.put(ImageTransfer(data, src, target, pedigree,
+                                        contentsource, t_item))
+
+    def _progress_callback(self, transfer):
+        if not self.image_progress_callback:
+            return None
+        name = transfer.t_item['name']
+        size = transfer.data.get('size', 0)
+
+        def progress_wrapper(written):
+            self.image_progress_callback(dict(status="Downloading",
+                                              name=name, size=size,
+                                              written=written))
+        return progress_wrapper
+
+    def _modify_hook(self):
+        modify_hook = self.config.get('modify_hook')
+        if modify_hook in NOOP_MODIFY_HOOKS:
+            return None
+        return modify_hook
+
+    def download_item(self, transfer):
+        transfer.progress_callback = self._progress_callback(transfer)
+        url = content_url(transfer.contentsource)
+        is_http = url and urlsplit(url).scheme in ('http', 'https')
+        if is_http and self.stream_uploads and not self._modify_hook():
+            # the upload stage reads straight from the mirror
+            transfer.stream_url = url
+            return
+
+        log.info("downloading {}".format("/".join(transfer.pedigree)))
+        with profiler.phase('download') as phase:
+            if not is_http:
+                kwargs = {}
+                if transfer.progress_callback:
+                    kwargs['progress_callback'] = transfer.progress_callback
+                transfer.path, transfer.delete_path = get_local_copy(
+                    transfer.contentsource, **kwargs)
+                phase.bytes = os.path.getsize(transfer.path)
+            else:
+                transfer.download = ResumableDownload(
+                    url, size=transfer.data.get('size'),
+                    sha256=transfer.data.get('sha256'),
+                    md5=transfer.data.get('md5'),
+                    progress_callback=transfer.progress_callback)
+                transfer.path = transfer.download.fetch()
+                transfer.checksums = transfer.download.checksums
+                phase.bytes = transfer.checksums.size
+        transfer.download_seconds = phase.seconds
+
+    def run_modify_hook(self, modify_hook, flat, transfer):
+        """Runs modify_hook on the downloaded image and returns its new
+        (size, md5). The image is only read again if the hook changed
+        it."""
+        env = os.environ.copy()
+        env.update((k, str(v)) for k, v in flat.items())
+        env['IMAGE_PATH'] = transfer.path
+        env['FIELDS'] = ' '.join(flat.keys()) + ' IMAGE_PATH'
+
+        before = os.stat(transfer.path)
+        subprocess.check_call(shlex.split(modify_hook), env=env)
+        after = os.stat(transfer.path)
+
+        if transfer.checksums is not None and \
+                (before.st_size, before.st_mtime, before.st_ino) == \
+                (after.st_size, after.st_mtime, after.st_ino):
+            return transfer.checksums.size, transfer.checksums.hexdigest('md5')
+
+        checksums = ImageChecksums()
+        with open(transfer.path, 'rb') as f:
+            for buf in read_chunks(f):
+                checksums.update(buf)
+        return checksums.size, checksums.hexdigest('md5')
+
+    def glance_create_kwargs(self, transfer, flat, size, md5):
+        props = {'content_id': transfer.target['content_id'],
+                 'source_content_id': transfer.src['content_id']}
+        for n in ('product_name', 'version_name', 'item_name'):
+            props[n] = flat[n]
+
+        arch = flat.get('arch')
+        if arch == "amd64":
+            arch = "x86_64"
+        if arch:
+            props['architecture'] = arch
+
+        create_kwargs = {'name': transfer.t_item['name'],
+                         'properties': props,
+                         'disk_format': 'qcow2',
+                         'container_format': 'bare',
+                         'is_public': True}
+        if size is not None:
+            create_kwargs['size'] = size
+        if md5 is not None:
+            create_kwargs['checksum'] = md5
+        return create_kwargs
+
+    def upload_item(self, transfer):
+        if transfer.stream_url:
+            return self.stream_item(transfer)
+
+        flat = products_exdata(transfer.src, transfer.pedigree,
+                               include_top=False)
+        t_item = transfer.t_item
+        if transfer.checksums is not None:
+            size = transfer.checksums.size
+            md5 = transfer.checksums.hexdigest('md5')
+        else:
+            size = transfer.data.get('size')
+            md5 = transfer.data.get('md5')
+
+        modify_hook = self._modify_hook()
+        if modify_hook:
+            size, md5 = self.run_modify_hook(modify_hook, flat, transfer)
+            t_item['size'] = size
+            t_item['md5'] = md5
+
+        create_kwargs = self.glance_create_kwargs(transfer, flat, size, md5)
+        with profiler.phase('upload') as phase:
+            with open(transfer.path, 'rb') as image_data:
+                create_kwargs['data'] = image_data
+                ret = self.gclient.images.create(**create_kwargs)
+            phase.bytes = size or 0
+        t_item['id'] = ret.id
+        transfer.uploaded = True
+        log.info("created {}: {}".format(ret.id, t_item['name']))
+        self.record_transfer(transfer, size, phase.seconds)
+
+    def record_transfer(self, transfer, size, upload_seconds):
+        profiler.record_item(item="/".join(transfer.pedigree),
+                             image=transfer.t_item['name'],
+                             bytes=size,
+                             download_seconds=transfer.download_seconds,
+                             upload_seconds=upload_seconds)
+
+    def stream_item(self, transfer):
+        """Uploads an image to glance as it is downloaded, hashing the
+        same chunks on the way. An image that turns out not to match
+        its checksums is deleted from glance again."""
+        flat = products_exdata(transfer.src, transfer.pedigree,
+                               include_top=False)
+        data = transfer.data
+        create_kwargs = self.glance_create_kwargs(transfer, flat,
+                                                  data.get('size'),
+                                                  data.get('md5'))
+
+        log.info("streaming {} into glance".format(transfer.stream_url))
+        checksums = ImageChecksums()
+        response = urllib2.urlopen(transfer.stream_url,
+                                   timeout=DOWNLOAD_TIMEOUT)
+        chunks = reported_chunks(hashed_chunks(read_chunks(response),
+                                               checksums),
+                                 transfer.progress_callback)
+        create_kwargs['data'] = ChunkReader(chunks)
+        with profiler.phase('stream_upload') as phase:
+            ret = self.gclient.images.create(**create_kwargs)
+            phase.bytes = checksums.size
+        try:
+            checksums.verify(transfer.stream_url, size=data.get('size'),
+                             sha256=data.get('sha256'), md5=data.get('md5'))
+        except IOError:
+            log.error("deleting image {} streamed from {}".format(
+                ret.id, transfer.stream_url))
+            self.gclient.images.delete(ret.id)
+            raise
+        transfer.t_item['id'] = ret.id
+        transfer.uploaded = True
+        log.info("created {}: {}".format(ret.id, transfer.t_item['name']))
+        self.record_transfer(transfer, checksums.size, phase.seconds)
+
+    def remove_item(self, data, src, target, pedigree):
+        self.deferred_removals.append((data, src, target, pedigree))
+
+    def insert_products(self, path, target, content):
+        self.pipeline.wait()
+        removals, self.deferred_removals = self.deferred_removals, []
+        for data, src, rtarget, pedigree in removals:
+            try:
+                with profiler.phase('glance_delete'):
+                    super(PipelinedGlanceMirror, self).remove_item(
+                        data, src, rtarget, pedigree)
+            except glanceclient.exc.HTTPNotFound:
+                log.warning("image {} of {} was already removed from "
+                            "glance".format(data.get('id'),
+                                            "/".join(pedigree)))
+                products_del(rtarget, pedigree)
+
+        added, self.index_added = self.index_added, []
+        image_index.record(self.config['content_id'], added,
+                           [pedigree for data, src, rtarget, pedigree
+                            in removals])
+        super(PipelinedGlanceMirror, self).insert_products(path, target,
+                                                           content)
+
+
+def swift_not_found(exc):
+    return (isinstance(exc, swift_client.ClientException) and
+            exc.http_status == 404)
+
+
+class SwiftWrite(object):
+    """A write or removal of one object, queued on a
+    ParallelSwiftObjectStore.
+
+    Content of up to one segment is held in memory. Larger content is
+    spooled to filename, and segment_md5s holds the md5 of each
+    segment_size piece of it.
+    """
+
+    def __init__(self, path, content=None, filename=None, size=0,
+                 md5=None, segment_md5s=None, remove=False):
+        self.path = path
+        self.content = content
+        self.filename = filename
+        self.size = size
+        self.md5 = md5
+        self.segment_md5s = segment_md5s or []
+        self.remove = remove
+        self.done = threading.Event()
+
+    def finish(self):
+        if self.filename is not None:
+            os.unlink(self.filename)
+            self.filename = None
+        self.done.set()
+
+
+class ParallelSwiftObjectStore(SwiftObjectStore):
+    """SwiftObjectStore that writes objects in parallel.
+
+    insert(), insert_content() and remove() only queue the change, and
+    return once the content has been read. Up to `workers` threads
+    apply the queued changes, each over its own swift connection from a
+    pool. Changes to one path are applied in order, and a change that
+    is superseded before it starts is dropped. A change of an
+    index.json waits for every change queued before it, and is refused
+    if any of them failed, so an index never points at products
+    documents that are missing or stale.
+
+    Reads see this store's own writes: source() answers from memory for
+    content written here, and waits for a pending write of a spooled
+    large object before fetching it.
+
+    An object whose stored etag, or md5 header for a large object,
+    matches the new content is not uploaded again. Content larger than
+    segment_size is uploaded as a static large object, with its
+    segments uploaded in parallel; segments that already hold the
+    right data are kept. Clusters without the SLO middleware get one
+    plain upload instead.
+
+    close() waits for every queued change and raises the first error.
+    """
+
+    def __init__(self, prefix, region=None, workers=SWIFT_WORKERS,
+                 segment_size=SWIFT_SEGMENT_SIZE):
+        super(ParallelSwiftObjectStore, self).__init__(prefix, region=region)
+        # self.swiftclient stays with the calling thread, see
+        # exists_with_checksum()
+        self.conn_info = openstack.get_service_conn_info(
+            'object-store', **self.keystone_creds)
+        self.workers = max(1, workers)
+        self.segment_size = segment_size
+        self.segment_container = self.container + '_segments'
+        self.connections = Queue.Queue()
+        self.nconnections = 0
+        self.lock = threading.Lock()
+        self.tasks = Queue.Queue()
+        self.threads = []
+        self.failures = []
+        # path -> newest queued SwiftWrite
+        self.latest = {}
+        self.path_locks = collections.defaultdict(threading.Lock)
+        # path -> content written by this store, None if removed
+        self.written = {}
+        self.slo = None
+
+    @contextlib.contextmanager
+    def connection(self):
+        try:
+            conn = self.connections.get_nowait()
+        except Queue.Empty:
+            with self.lock:
+                create = self.nconnections < self.workers
+                if create:
+                    self.nconnections += 1
+            if create:
+                try:
+                    conn = get_swiftclient(**self.conn_info)
+                except:
+                    # leave room for another attempt
+                    with self.lock:
+                        self.nconnections -= 1
+                    raise
+            else:
+                try:
+                    conn = self.connections.get(
+                        timeout=SWIFT_CONNECTION_TIMEOUT)
+                except Queue.Empty:
+                    raise IOError("no swift connection became free within "
+                                  "{}s".format(SWIFT_CONNECTION_TIMEOUT))
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+
+    def _obj(self, path):
+        return self.path_prefix + path
+
+    def _worker(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                if task is None:
+                    return
+                task()
+            except Exception:
+                log.exception("Exception writing to swift")
+                self.failures.append(sys.exc_info())
+            finally:
+                self.tasks.task_done()
+
+    def _raise_failure(self):
+        if self.failures:
+            exc_type, exc_value, exc_tb = self.failures[0]
+            raise exc_type, exc_value, exc_tb
+
+    def _queue(self, write):
+        if posixpath.basename(write.path) == 'index.json':
+            # simplestreams writes the documents an index refers to
+            # before the index itself, which parallel writes would
+            # otherwise reorder
+            self.tasks.join()
+            try:
+                self._raise_failure()
+            except:
+                write.finish()
+                raise
+        with self.lock:
+            if not self.threads:
+                for n in range(self.workers):
+                    self.threads.append(profiler.start_thread(
+                        self._worker, "{}-swift-{}".format(
+                            threading.current_thread().name, n)))
+            self.latest[write.path] = write
+            if write.remove:
+                self.written[write.path] = None
+            elif write.filename is None:
+                self.written[write.path] = write.content
+            else:
+                self.written.pop(write.path, None)
+        self.tasks.put(lambda: self._apply(write))
+
+    def _spool(self, reader):
+        """Reads reader into a SwiftWrite's content, or into a spool
+        file once it grows beyond one segment."""
+        md5 = hashlib.md5()
+        segment_md5 = hashlib.md5()
+        segment_md5s = []
+        size = 0
+        buf = b''
+        spool = None
+        try:
+            while True:
+                chunk = reader.read(SWIFT_READ_SIZE)
+                if not chunk:
+                    break
+                while chunk:
+                    room = self.segment_size - size % self.segment_size
+                    piece, chunk = chunk[:room], chunk[room:]
+                    md5.update(piece)
+                    segment_md5.update(piece)
+                    size += len(piece)
+                    if size % self.segment_size == 0:
+                        segment_md5s.append(segment_md5.hexdigest())
+                        segment_md5 = hashlib.md5()
+                    if spool is None and len(buf) + len(piece) > \
+                            self.segment_size:
+                        if not os.path.isdir(SWIFT_SPOOL_DIR):
+                            os.makedirs(SWIFT_SPOOL_DIR)
+                        spool = tempfile.NamedTemporaryFile(
+                            dir=SWIFT_SPOOL_DIR, delete=False)
+                        spool.write(buf)
+                        buf = b''
+                    if spool is None:
+                        buf += piece
+                    else:
+                        spool.write(piece)
+            if size % self.segment_size:
+                segment_md5s.append(segment_md5.hexdigest())
+        except:
+            if spool is not None:
+                spool.close()
+                os.unlink(spool.name)
+            raise
+        finally:
+            reader.close()
+
+        if spool is None:
+            return dict(content=buf, size=size, md5=md5.hexdigest())
+        spool.close()
+        return dict(filename=spool.name, size=size, md5=md5.hexdigest(),
+                    segment_md5s=segment_md5s)
+
+    def insert(self, path, reader, checksums=None, mutable=True, size=None):
+        self._queue(SwiftWrite(path, **self._spool(reader)))
+
+    def insert_content(self, path, content, checksums=None, mutable=True):
+        self._queue(SwiftWrite(path, content=content, size=len(content),
+                               md5=hashlib.md5(content).hexdigest()))
+
+    def remove(self, path):
+        self._queue(SwiftWrite(path, remove=True))
+
+    def _wait_pending(self, path):
+        with self.lock:
+            write = self.latest.get(path)
+        if write is not None:
+            write.done.wait()
+
+    def source(self, path):
+        with self.lock:
+            if path in self.written:
+                content = self.written[path]
+                if content is None:
+                    raise IOError(errno.ENOENT, '%s not found' % path)
+                return contentsource.MemoryContentSource(url=path,
+                                                         content=content)
+        self._wait_pending(path)
+        try:
+            with self.connection() as conn, \
+                    profiler.phase('swift_get') as phase:
+                headers, content = conn.get_object(self.container,
+                                                   self._obj(path))
+                phase.bytes = len(content)
+        except swift_client.ClientException as e:
+            if swift_not_found(e):
+                raise IOError(errno.ENOENT, '%s not found' % path)
+            raise
+        return contentsource.MemoryContentSource(url=path, content=content)
+
+    def exists_with_checksum(self, path, checksums=None):
+        self._wait_pending(path)
+        return super(ParallelSwiftObjectStore, self).exists_with_checksum(
+            path, checksums)
+
+    def _head(self, container, obj):
+        try:
+            with self.connection() as conn, profiler.phase('swift_head'):
+                return conn.head_object(container, obj)
+        except swift_client.ClientException as e:
+            if swift_not_found(e):
+                return {}
+            raise
+
+    def _apply(self, write):
+        with self.path_locks[write.path]:
+            try:
+                with self.lock:
+                    if self.latest.get(write.path) is not write:
+                        # a newer change of this path is queued
+                        return
+                if write.remove:
+                    self._delete(write)
+                    return
+                headers = self._head(self.container, self._obj(write.path))
+                stored_md5 = headers.get(SWIFT_MD5_HEADER,
+                                         headers.get('etag', '').strip('"'))
+                if stored_md5 == write.md5:
+                    profiler.record('swift_unchanged')
+                    return
+                if write.filename is not None and self._slo_supported():
+                    self._put_segmented(write)
+                else:
+                    self._put(write)
+                if headers.get('x-static-large-object') and stored_md5:
+                    # the old manifest is gone, and its segments with it
+                    self._delete_segments(write.path, stored_md5)
+            finally:
+                with self.lock:
+                    if self.latest.get(write.path) is write:
+                        del self.latest[write.path]
+                write.finish()
+
+    def _put(self, write):
+        if write.filename is not None:
+            contents = open(write.filename, 'rb')
+        else:
+            contents = write.content
+        try:
+            with self.connection() as conn, \
+                    profiler.phase('swift_put') as phase:
+                conn.put_object(self.container, self._obj(write.path),
+                                contents, content_length=write.size,
+                                etag=write.md5,
+                                headers={SWIFT_MD5_HEADER: write.md5})
+                phase.bytes = write.size
+        finally:
+            if write.filename is not None:
+                contents.close()
+
+    def _delete(self, write):
+        try:
+            with self.connection() as conn, profiler.phase('swift_delete'):
+                # also removes the segments of a large object
+                conn.delete_object(self.container, self._obj(write.path),
+                                   query_string='multipart-manifest=delete')
+        except swift_client.ClientException as e:
+            if not swift_not_found(e):
+                raise
+
+    def _slo_supported(self):
+        if self.slo is None:
+            try:
+                with self.connection() as conn:
+                    self.slo = 'slo' in conn.get_capabilities()
+            except Exception:
+                log.exception("could not query swift capabilities, not "
+                              "using static large objects")
+                self.slo = False
+        return self.slo
+
+    def _segment_prefix(self, path, md5):
+        return "{}/{}/".format(self._obj(path), md5)
+
+    def _put_segmented(self, write):
+        """Uploads the segments of write in parallel, then its manifest.
+        Segments are named after the md5 of the whole content, so a
+        retried upload keeps those already stored."""
+        with self.connection() as conn:
+            conn.put_container(self.segment_container,
+                               headers={'X-Container-Read': SWIFT_READ_ACL})
+
+        prefix = self._segment_prefix(write.path, write.md5)
+        segments = Queue.Queue()
+        manifest = []
+        for n, segment_md5 in enumerate(write.segment_md5s):
+            offset = n * self.segment_size
+            size = min(self.segment_size, write.size - offset)
+            name = "{}{:08d}".format(prefix, n)
+            segments.put((name, offset, size, segment_md5))
+            manifest.append({'path': '/{}/{}'.format(self.segment_container,
+                                                     name),
+                             'etag': segment_md5,
+                             'size_bytes': size})
+
+        failures = []
+
+        def upload_segments():
+            with open(write.filename, 'rb') as f:
+                while not failures:
+                    try:
+                        name, offset, size, segment_md5 = segments.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        headers = self._head(self.segment_container, name)
+                        if headers.get('etag', '').strip('"') == segment_md5:
+                            profiler.record('swift_unchanged')
+                            continue
+                        f.seek(offset)
+                        with self.connection() as conn, \
+                                profiler.phase('swift_put') as phase:
+                            conn.put_object(self.segment_container, name, f,
+                                            content_length=size,
+                                            etag=segment_md5)
+                            phase.bytes = size
+                    except Exception:
+                        log.exception("Exception uploading segment "
+                                      "{}".format(name))
+                        failures.append(sys.exc_info())
+
+        threads = [profiler.start_thread(upload_segments, "{}-{}".format(
+            threading.current_thread().name, n))
+            for n in range(min(self.workers, len(manifest)))]
+        for t in threads:
+            t.join()
+        if failures:
+            exc_type, exc_value, exc_tb = failures[0]
+            raise exc_type, exc_value, exc_tb
+
+        with self.connection() as conn, profiler.phase('swift_put'):
+            conn.put_object(self.container, self._obj(write.path),
+                            json.dumps(manifest),
+                            query_string='multipart-manifest=put',
+                            headers={SWIFT_MD5_HEADER: write.md5})
+
+    def _delete_segments(self, path, md5):
+        """Removes the segments of a large object's previous content."""
+        prefix = self._segment_prefix(path, md5)
+        with self.connection() as conn:
+            headers, objects = conn.get_container(self.segment_container,
+                                                  prefix=prefix,
+                                                  full_listing=True)
+            for obj in objects:
+                try:
+                    with profiler.phase('swift_delete'):
+                        conn.delete_object(self.segment_container,
+                                           obj['name'])
+                except swift_client.ClientException as e:
+                    if not swift_not_found(e):
+                        raise
+
+    def close(self):
+        """Waits for every queued change, stops the workers and raises
+        the first error any change ran into."""
+        self.tasks.join()
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for t in threads:
+            self.tasks.put(None)
+        for t in threads:
+            t.join()
+        try:
+            self._raise_failure()
+        finally:
+            self.failures = []
+
+
+class ConfigError(Exception):
+    """Raised for a config file that cannot be parsed or has invalid
+    values. The message names the file and the offending setting."""
+
+
+# the libyaml-based loader is several times faster, where available
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# same syntax as simplestreams.filters.ItemFilter
+ITEM_FILTER_RE = re.compile(r"([\w|\-]+)[ ]*([!]{0,1}[=~])[ ]*(.*)[ ]*$")
+
+MIRROR_URL_SCHEMES = ('http', 'https', 'file')
+
+compiled_item_filters = {}
+
+
+def compile_item_filters(item_filters):
+    """Parses item_filters into (key, op, value) tuples, with the value
+    of regex ops compiled. Raises ValueError for an invalid filter.
+
+    Results are cached, as every sync of a mirror uses the same
+    filters.
+    """
+    key = tuple(item_filters)
+    compiled = compiled_item_filters.get(key)
+    if compiled is None:
+        compiled = []
+        for item_filter in item_filters:
+            match = ITEM_FILTER_RE.match(item_filter)
+            if not match:
+                raise ValueError("unable to parse {!r}".format(item_filter))
+            field, op, value = match.groups()
+            if op.endswith('~'):
+                try:
+                    value = re.compile(value)
+                except re.error as e:
+                    raise ValueError("invalid regex in {!r}: {}".format(
+                        item_filter, e))
+            compiled.append((field, op, value))
+        compiled_item_filters[key] = compiled
+    return compiled
+
+
+# what GlanceMirror filters with when a mirror has no item_filters
+DEFAULT_ITEM_FILTERS = ['ftype~(disk1.img|disk.img)',
+                        'arch~(x86_64|amd64|i386)']
+
+# (container, field name) of each level of a products tree, as in
+# simplestreams.util.products_exdata()
+PRODUCTS_HIERARCHY = (('products', 'product_name'),
+                      ('versions', 'version_name'),
+                      ('items', 'item_name'))
+
+
+class ItemMatcher(object):
+    """Evaluates a mirror's item_filters against items of a products
+    tree, with the results of simplestreams.filters.filter_item().
+
+    The filters are parsed and their regexes compiled once, by
+    compile_item_filters(). For each item, a field is looked up in the
+    item, its version, its product and the top of the tree only when a
+    filter needs it, instead of flattening all of them with
+    products_exdata(). Equality filters run before regex searches, and
+    every reorder_interval items the filters are reordered so that
+    those rejecting the most items run first.
+    """
+
+    def __init__(self, item_filters, reorder_interval=1000):
+        self.filters = []
+        for n, (field, op, value) in enumerate(
+                compile_item_filters(item_filters)):
+            test = value.search if op.endswith('~') else value.__eq__
+            self.filters.append((n, field, test, op.startswith('!'),
+                                 op.endswith('~')))
+        self.filters.sort(key=lambda f: f[4])
+        self.rejects = [0] * len(self.filters)
+        self.reorder_interval = reorder_interval
+        self.evaluated = 0
+
+    def reorder(self):
+        # stable, so equality filters still go first between equals
+        self.filters = sorted(self.filters, key=lambda f: -self.rejects[f[0]])
+
+    def field(self, src, levels, name):
+        """Returns the value products_exdata(src, pedigree)[name] would
+        have, where levels holds the (field name, key, dict) of each
+        level of pedigree, most specific first."""
+        for fieldname, key, level in levels:
+            if name == fieldname:
+                return key
+            value = level.get(name)
+            if isinstance(value, basestring):
+                return value
+        value = src.get(name)
+        if isinstance(value, basestring):
+            return value
+        return ""
+
+    def matches(self, src, pedigree):
+        if not self.filters:
+            return True
+        self.evaluated += 1
+        if self.evaluated % self.reorder_interval == 0:
+            self.reorder()
+
+        levels = []
+        level = src
+        for (container, fieldname), key in zip(PRODUCTS_HIERARCHY, pedigree):
+            level = level.get(container, {}).get(key, {})
+            levels.append((fieldname, key, level))
+        levels.reverse()
+
+        for n, name, test, negate, is_regex in self.filters:
+            if bool(test(str(self.field(src, levels, name)))) == negate:
+                self.rejects[n] += 1
+                return False
+        return True
+
+
 def read_conf(filename):
-    with open(filename) as f:
-        confobj = yaml.load(f)
+    try:
+        with open(filename) as f:
+            confobj = yaml.load(f, Loader=YAML_LOADER)
+    except yaml.YAMLError as e:
+        raise ConfigError("{}: {}".format(filename, e))
+    if not isinstance(confobj, dict):
+        raise ConfigError("{}: expected a mapping, got {!r}".format(
+            filename, confobj))
     return confobj
 
 
-def get_conf():
+def validate_mirror(filename, n, mirror_info):
+    """Raises ConfigError unless mirror_info, entry n of mirror_list,
+    has everything sync_mirror() needs."""
+    where = "{}: mirror_list[{}]".format(filename, n)
+    if not isinstance(mirror_info, dict):
+        raise ConfigError("{}: expected a mapping, got {!r}".format(
+            where, mirror_info))
+
+    for key in ['url', 'path', 'max', 'item_filters']:
+        if key not in mirror_info:
+            raise ConfigError("{}: '{}' is missing".format(where, key))
+
+    url = mirror_info['url']
+    if not isinstance(url, basestring) or (
+            urlsplit(url).scheme not in MIRROR_URL_SCHEMES):
+        raise ConfigError("{}: 'url' must be an {} URL, got {!r}".format(
+            where, '/'.join(MIRROR_URL_SCHEMES), url))
+
+    path = mirror_info['path']
+    if not isinstance(path, basestring) or not path:
+        raise ConfigError("{}: 'path' must be a non-empty string, got "
+                          "{!r}".format(where, path))
+
+    max_items = mirror_info['max']
+    if (isinstance(max_items, bool) or not isinstance(max_items, int) or
+            max_items < 1):
+        raise ConfigError("{}: 'max' must be a positive integer, got "
+                          "{!r}".format(where, max_items))
+
+    item_filters = mirror_info['item_filters']
+    if not isinstance(item_filters, list) or not all(
+            isinstance(f, basestring) for f in item_filters):
+        raise ConfigError("{}: 'item_filters' must be a list of strings, "
+                          "got {!r}".format(where, item_filters))
+    try:
+        compile_item_filters(item_filters)
+    except ValueError as e:
+        raise ConfigError("{}: 'item_filters': {}".format(where, e))
+
+
+def validate_charm_conf(filename, charm_conf):
+    mirror_list = charm_conf.get('mirror_list')
+    if mirror_list is None:
+        # incomplete, see load_conf()
+        return
+    if not isinstance(mirror_list, list) or not mirror_list:
+        raise ConfigError("{}: mirror_list must be a non-empty list, got "
+                          "{!r}".format(filename, mirror_list))
+    for n, mirror_info in enumerate(mirror_list):
+        validate_mirror(filename, n, mirror_info)
+
+
+def validate_id_conf(filename, id_conf):
+    port = id_conf.get('service_port')
+    if port is not None and (isinstance(port, bool) or
+                             not isinstance(port, int)):
+        raise ConfigError("{}: service_port must be an integer, got "
+                          "{!r}".format(filename, port))
+
+
+class ConfigCache(object):
+    """Parsed and validated config files, re-read only when a file's
+    mtime, size or inode changes.
+
+    A file that failed validation raises the same ConfigError again
+    until it changes. Callers get their own copy of the parsed file.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, filename, validate):
+        st = os.stat(filename)
+        stamp = (st.st_mtime, st.st_size, st.st_ino)
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None or entry[0] != stamp:
+                try:
+                    conf = read_conf(filename)
+                    validate(filename, conf)
+                    entry = (stamp, conf, None)
+                except ConfigError as e:
+                    entry = (stamp, None, e)
+                self.entries[filename] = entry
+        stamp, conf, error = entry
+        if error is not None:
+            raise error
+        return copy.deepcopy(conf)
+
+
+conf_cache = ConfigCache()
+
+
+def conf_stamps():
+    """Returns the mtime, size and inode of each config file, or None
+    for a missing one, to tell when the hooks have rewritten them."""
+    stamps = []
+    for conf_file_name in [ID_CONF_FILE_NAME, CHARM_CONF_FILE_NAME]:
+        try:
+            st = os.stat(conf_file_name)
+        except OSError:
+            stamps.append(None)
+        else:
+            stamps.append((st.st_mtime, st.st_size, st.st_ino))
+    return stamps
+
+
+def load_conf():
+    """Returns (id_conf, charm_conf), or None if either file is missing
+    or incomplete. Raises ConfigError if either is invalid, which is
+    checked before anything is contacted."""
     conf_files = [ID_CONF_FILE_NAME, CHARM_CONF_FILE_NAME]
     for conf_file_name in conf_files:
         if not os.path.exists(conf_file_name):
-            log.info("{} does not exist, exiting.".format(conf_file_name))
-            sys.exit(1)
+            log.info("{} does not exist.".format(conf_file_name))
+            return None
 
-    id_conf = read_conf(ID_CONF_FILE_NAME)
+    id_conf = conf_cache.get(ID_CONF_FILE_NAME, validate_id_conf)
     if None in id_conf.values():
         log.info("Configuration value missing in {}:\n"
                  "{}".format(ID_CONF_FILE_NAME, id_conf))
-        sys.exit(1)
-    charm_conf = read_conf(CHARM_CONF_FILE_NAME)
+        return None
+    charm_conf = conf_cache.get(CHARM_CONF_FILE_NAME, validate_charm_conf)
     if None in charm_conf.values():
         log.info("Configuration value missing in {}:\n"
                  "{}".format(CHARM_CONF_FILE_NAME, charm_conf))
-        sys.exit(1)
+        return None
 
     return id_conf, charm_conf
 
 
+def get_conf():
+    try:
+        conf = load_conf()
+    except ConfigError as e:
+        log.error("Invalid configuration, exiting: {}".format(e))
+        sys.exit(1)
+    if conf is None:
+        log.info("Configuration incomplete, exiting.")
+        sys.exit(1)
+    return conf
+
+
 def set_openstack_env(id_conf, charm_conf):
     auth_url = '%s://%s:%s/v2.0' % (id_conf['service_protocol'],
                                     id_conf['service_host'],
@@ -163,144 +2337,691 @@ def set_openstack_env(id_conf, charm_conf):
     os.environ['OS_REGION_NAME'] = charm_conf['region']
 
 
-def do_sync(charm_conf, status_exchange):
+def mirror_label(mirror_info):
+    """Returns a short human-readable name for a mirror_list entry."""
+    return mirror_info.get('name_prefix', mirror_info['url'])
 
-    for mirror_info in charm_conf['mirror_list']:
-        mirror_url, initial_path = path_from_mirror_url(mirror_info['url'],
-                                                        mirror_info['path'])
 
-        log.info("configuring sync for url {}".format(mirror_info))
+mirror_state = StateFile(MIRROR_STATE_FILE_NAME)
 
-        smirror = UrlMirrorReader(mirror_url, policy=policy)
 
-        if charm_conf['use_swift']:
-            store = SwiftObjectStore(SWIFT_DATA_DIR)
-        else:
-            store = None
+class ContentWriters(object):
+    """Tracks the mirrors of this run that are writing to the same
+    content_id at the same time.
 
-        content_id = charm_conf['content_id_template'].format(
-            region=charm_conf['region'])
+    Such mirrors race on the metadata of the content_id in swift, so
+    whichever of them finishes last must not record its sync as
+    complete: its next sync then runs in full and regenerates that
+    metadata from glance, instead of being skipped as unchanged.
+    """
 
-        config = {'max_items': mirror_info['max'],
-                  'modify_hook': charm_conf['modify_hook_scripts'],
-                  'keep_items': False,
-                  'content_id': content_id,
-                  'cloud_name': charm_conf['cloud_name'],
-                  'item_filters': mirror_info['item_filters']}
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = collections.Counter()
+        self.overlapped = set()
+
+    @contextlib.contextmanager
+    def writing(self, content_id):
+        """Yields a list that is [True] once the block exits if it was
+        the last of several overlapping writers of content_id."""
+        raced = []
+        with self.lock:
+            self.active[content_id] += 1
+            if self.active[content_id] > 1:
+                self.overlapped.add(content_id)
+        try:
+            yield raced
+        finally:
+            with self.lock:
+                self.active[content_id] -= 1
+                if (not self.active[content_id] and
+                        content_id in self.overlapped):
+                    self.overlapped.discard(content_id)
+                    raced.append(True)
+
+
+content_writers = ContentWriters()
+
+
+def mirror_fingerprint(charm_conf, mirror_info, content_id):
+    """Identifies everything besides upstream metadata that decides
+    what a sync of mirror_info puts into glance."""
+    settings = [mirror_info, content_id, charm_conf['name_prefix'],
+                charm_conf['modify_hook_scripts'], charm_conf['cloud_name'],
+                charm_conf['use_swift']]
+    return hashlib.sha256(json.dumps(settings, sort_keys=True)).hexdigest()
+
+
+def sync_mirror(charm_conf, mirror_info, status_exchange):
+    """Syncs one mirror.
+
+    Returns False without touching glance if the last successful sync
+    used the same settings and upstream reports every metadata document
+    it read as unmodified, True otherwise.
+    """
+    mirror_url, initial_path = path_from_mirror_url(mirror_info['url'],
+                                                    mirror_info['path'])
+
+    log.info("configuring sync for url {}".format(mirror_info))
 
-        mirror_args = dict(config=config, objectstore=store,
-                           name_prefix=charm_conf['name_prefix'])
+    content_id = charm_conf['content_id_template'].format(
+        region=charm_conf['region'])
 
-        if SIMPLESTREAMS_HAS_PROGRESS:
-            log.info("Calling DryRun mirror to get item list")
+    creader = CachingUrlMirrorReader(mirror_url, policy=policy)
+    fingerprint = mirror_fingerprint(charm_conf, mirror_info, content_id)
+    last_sync = mirror_state.get(fingerprint)
+    if last_sync and creader.unchanged(last_sync['paths']):
+        log.info("no upstream changes for {}, skipping".format(mirror_url))
+        profiler.record('mirror_unchanged')
+        return False
 
-            drmirror = glance.ItemInfoDryRunMirror(config=config,
-                                                   objectstore=store)
+    smirror = MemoizingMirrorReader(creader)
+
+    if charm_conf['use_swift']:
+        store = ParallelSwiftObjectStore(SWIFT_DATA_DIR)
+    else:
+        store = None
+
+    config = {'max_items': mirror_info['max'],
+              'modify_hook': charm_conf['modify_hook_scripts'],
+              'keep_items': False,
+              'content_id': content_id,
+              'cloud_name': charm_conf['cloud_name'],
+              'item_filters': mirror_info['item_filters']}
+
+    item_matcher = ItemMatcher(mirror_info['item_filters'] or
+                               DEFAULT_ITEM_FILTERS)
+
+    mirror_args = dict(config=config, objectstore=store,
+                       name_prefix=charm_conf['name_prefix'],
+                       item_matcher=item_matcher)
+
+    if SIMPLESTREAMS_HAS_PROGRESS:
+        log.info("Calling DryRun mirror to get item list")
+
+        planned_targets = {}
+        drmirror = PlanningDryRunMirror(config=config, objectstore=store,
+                                        planned_targets=planned_targets,
+                                        item_matcher=item_matcher)
+        with profiler.phase('plan'):
             drmirror.sync(smirror, path=initial_path)
-            p = StatusMessageProgressAggregator(drmirror.items,
-                                                status_exchange.send_message)
-            mirror_args['progress_callback'] = p.progress_callback
+        mirror_args['planned_targets'] = planned_targets
+        p = StatusMessageProgressAggregator(
+            drmirror.items, status_exchange.send_message,
+            min_interval=charm_conf.get('progress_min_interval',
+                                        PROGRESS_MIN_INTERVAL),
+            min_percent=charm_conf.get('progress_min_percent',
+                                       PROGRESS_MIN_PERCENT))
+        mirror_args['progress_callback'] = p.progress_callback
+    else:
+        log.info("Detected simplestreams version without progress"
+                 " update support. Only limited feedback available.")
+
+    mirror_args['downloaders'] = int(charm_conf.get('image_download_workers',
+                                                    1))
+    mirror_args['uploaders'] = int(charm_conf.get('image_upload_workers', 1))
+    mirror_args['queue_size'] = int(charm_conf.get('image_queue_size', 1))
+    mirror_args['stream_uploads'] = charm_conf.get('stream_image_uploads',
+                                                   False)
+    tmirror = PipelinedGlanceMirror(**mirror_args)
+
+    log.info("calling PipelinedGlanceMirror.sync")
+    with content_writers.writing(content_id) as raced:
+        try:
+            with profiler.phase('sync'):
+                tmirror.sync(smirror, path=initial_path)
+        finally:
+            if store is not None:
+                with profiler.phase('swift_wait'):
+                    store.close()
+
+    if raced and store is not None:
+        log.info("{} raced other mirrors on the swift metadata of {}, "
+                 "it will be synced in full next time".format(mirror_url,
+                                                             content_id))
+        mirror_state.modify(fingerprint, lambda old: None)
+    else:
+        mirror_state.set(fingerprint,
+                         {'paths': sorted(set(creader.paths_read)),
+                          'synced_at': time.time()})
+    return True
+
+
+metrics_state = StateFile(METRICS_STATE_FILE_NAME)
+
+
+def record_mirror_result(label, success):
+    """Keeps the time of the last successful sync and the number of
+    failed syncs of each mirror across runs, for the metrics."""
+    def update(state):
+        state = state or {'last_success': 0, 'failures': 0}
+        if success:
+            state['last_success'] = time.time()
         else:
-            log.info("Detected simplestreams version without progress"
-                     " update support. Only limited feedback available.")
+            state['failures'] += 1
+        return state
+    metrics_state.modify(label, update)
+
+
+def format_metric_labels(labels):
+    if not labels:
+        return ""
+    escaped = ['{}="{}"'.format(k, to_bytes(v).replace('\\', '\\\\')
+                                .replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in sorted(labels.items())]
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_metrics(report, mirrors):
+    """Returns the Prometheus text format of a SyncProfiler report of the
+    last run, or None before the first one, and of the per-mirror
+    records of record_mirror_result()."""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        name = "{}_{}".format(METRICS_PREFIX, name)
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, value in samples:
+            lines.append("{}{} {}".format(name, format_metric_labels(labels),
+                                          repr(float(value))))
+
+    metric('mirror_last_success_timestamp_seconds', 'gauge',
+           "Time of the last successful sync of each mirror.",
+           [({'mirror': m}, s['last_success'])
+            for m, s in sorted(mirrors.items())])
+    metric('mirror_failures_total', 'counter',
+           "Failed syncs of each mirror.",
+           [({'mirror': m}, s['failures'])
+            for m, s in sorted(mirrors.items())])
+
+    if report is not None:
+        phases = report['phases']
+
+        def count(stats, name):
+            return stats.get(name, {}).get('count', 0)
+
+        def nbytes(stats, *names):
+            return sum(stats.get(n, {}).get('bytes', 0) for n in names)
+
+        errors = [count(phases, e) for e in ERROR_COUNTS]
+        metric('last_run_timestamp_seconds', 'gauge',
+               "Time the last sync run finished.",
+               [({}, report['finished'])])
+        metric('last_run_duration_seconds', 'gauge',
+               "Duration of the last sync run.",
+               [({}, report['seconds'])])
+        metric('last_run_success', 'gauge',
+               "1 if the last sync run had no errors, 0 otherwise.",
+               [({}, 0 if any(errors) else 1)])
+        metric('last_run_errors', 'gauge',
+               "Errors of the last sync run, by type.",
+               [({'type': e}, n) for e, n in zip(ERROR_COUNTS, errors)])
+        metric('last_run_phase_seconds', 'gauge',
+               "Wall time spent in each phase of the last sync run.",
+               [({'phase': p}, phases[p]['seconds'])
+                for p in sorted(phases)])
+        metric('last_run_phase_calls', 'gauge',
+               "Number of times each phase ran in the last sync run.",
+               [({'phase': p}, phases[p]['count']) for p in sorted(phases)])
+        metric('last_run_api_seconds', 'gauge',
+               "Time spent in glance and keystone API calls in the last"
+               " sync run.",
+               [({'api': API_PHASES[p], 'phase': p}, phases[p]['seconds'])
+                for p in sorted(phases) if p in API_PHASES])
+        metric('last_run_api_calls', 'gauge',
+               "Number of glance and keystone API calls in the last sync"
+               " run.",
+               [({'api': API_PHASES[p], 'phase': p}, phases[p]['count'])
+                for p in sorted(phases) if p in API_PHASES])
+
+        mirror_stats = sorted(report['mirrors'].items())
+        metric('last_run_mirror_bytes', 'gauge',
+               "Image bytes downloaded and uploaded per mirror in the last"
+               " sync run.",
+               [({'mirror': m, 'direction': 'download'},
+                 nbytes(stats, 'download')) for m, stats in mirror_stats] +
+               [({'mirror': m, 'direction': 'upload'},
+                 nbytes(stats, 'upload', 'stream_upload'))
+                for m, stats in mirror_stats])
+        metric('last_run_mirror_images_added', 'gauge',
+               "Images added to glance per mirror in the last sync run.",
+               [({'mirror': m},
+                 count(stats, 'upload') + count(stats, 'stream_upload'))
+                for m, stats in mirror_stats])
+        metric('last_run_mirror_images_removed', 'gauge',
+               "Images removed from glance per mirror in the last sync"
+               " run.",
+               [({'mirror': m}, count(stats, 'glance_delete'))
+                for m, stats in mirror_stats])
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer(object):
+    """Serves the latest metrics text at /metrics from a background
+    thread, for the daemon mode."""
+
+    def __init__(self, port, text=""):
+        self.text = text
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                text = server.text
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(text)))
+                self.end_headers()
+                self.wfile.write(text)
+
+        self.port = port
+        self.httpd = HTTPServer(('', port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name="metrics-server")
+        self.thread.daemon = True
+        self.thread.start()
 
-        tmirror = glance.GlanceMirror(**mirror_args)
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
 
-        log.info("calling GlanceMirror.sync")
-        tmirror.sync(smirror, path=initial_path)
 
+def export_metrics(charm_conf, metrics_server=None, report=True):
+    """Writes the metrics of the run profiler just finished to the
+    metrics_textfile_dir option, if set, and to metrics_server."""
+    try:
+        text = format_metrics(profiler.report() if report else None,
+                              metrics_state.load())
+        if metrics_server is not None:
+            metrics_server.text = text
+        textfile_dir = charm_conf.get('metrics_textfile_dir')
+        if textfile_dir:
+            atomic_write(os.path.join(textfile_dir, METRICS_FILE_NAME),
+                         text)
+    except:
+        log.exception("Exception exporting metrics")
 
-def update_product_streams_service(ksc, services, region):
-    """
-    Updates URLs of product-streams endpoint to point to swift URLs.
-    """
 
-    swift_services = [s for s in services
-                      if s['name'] == 'swift']
-    if len(swift_services) != 1:
-        log.error("found {} swift services. expecting one."
-                  " - not updating endpoint.".format(len(swift_services)))
-        return
+# what run_sync() takes to mean that glance is not available yet
+GLANCE_NOT_READY_ERRORS = (keystone_exceptions.EndpointNotFound,
+                           glanceclient.exc.ClientException)
 
-    swift_service_id = swift_services[0]['id']
 
-    endpoints = [e._info for e in ksc.endpoints.list()
-                 if e._info['region'] == region]
+def do_sync(charm_conf, status_exchange):
+    """Syncs every mirror in mirror_list, up to max_concurrent_mirrors at
+    a time.
+
+    A failure in one mirror does not stop the others. Once all mirrors
+    are done, the first failure is re-raised so that main() can decide
+    whether to keep polling. Finding glance not ready is not a failure
+    of the mirror: no mirror is started after that, and it is re-raised
+    ahead of any other failure.
+    """
+    pending = Queue.Queue()
+    for mirror_info in charm_conf['mirror_list']:
+        pending.put(mirror_info)
+
+    ResumableDownload.expire()
+
+    nworkers = int(charm_conf.get('max_concurrent_mirrors', 1))
+    nworkers = max(1, min(nworkers, pending.qsize()))
+    failures = []
+    not_ready = []
+
+    def worker():
+        while True:
+            try:
+                mirror_info = pending.get_nowait()
+            except Queue.Empty:
+                return
+
+            label = mirror_label(mirror_info)
+            profiler.bind_mirror(label)
+            status_exchange.send_message(
+                {"status": "Syncing",
+                 "message": "Starting sync of {}.".format(label)})
+            try:
+                synced = sync_mirror(charm_conf, mirror_info,
+                                     status_exchange)
+            except GLANCE_NOT_READY_ERRORS:
+                log.info("glance not ready during sync of {}, not starting"
+                         " further mirrors".format(label))
+                not_ready.append(sys.exc_info())
+                while True:
+                    try:
+                        pending.get_nowait()
+                    except Queue.Empty:
+                        break
+            except Exception as e:
+                log.exception("Exception during sync of {}".format(label))
+                failures.append(sys.exc_info())
+                profiler.record('mirror_failed')
+                record_mirror_result(label, False)
+                status_exchange.send_message(
+                    {"status": "Syncing",
+                     "message": "Sync of {} failed: {}".format(label, e)})
+            else:
+                record_mirror_result(label, True)
+                if synced:
+                    msg = "Sync of {} completed.".format(label)
+                else:
+                    msg = "{} is unchanged since the last sync.".format(
+                        label)
+                status_exchange.send_message({"status": "Syncing",
+                                              "message": msg})
+
+    log.info("syncing {} mirrors with {} workers".format(pending.qsize(),
+                                                         nworkers))
+    threads = [profiler.start_thread(worker, "mirror-{}".format(n))
+               for n in range(nworkers)]
+    for t in threads:
+        t.join()
+
+    if failures:
+        log.error("{} of {} mirrors failed to sync".format(
+            len(failures), len(charm_conf['mirror_list'])))
+    for errors in (not_ready, failures):
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+
+
+ENDPOINT_URL_KEYS = ('publicurl', 'internalurl', 'adminurl')
+
+product_streams_state = StateFile(PRODUCT_STREAMS_STATE_FILE_NAME)
+
+
+def endpoint_urls(endpoint):
+    """Returns the URLs of a keystone v2 endpoint record."""
+    return dict((k, endpoint[k]) for k in ENDPOINT_URL_KEYS)
+
+
+def catalog_endpoint_urls(ksc, service_name, region):
+    """Returns the URLs of the service_name endpoint in region from the
+    service catalog of ksc, keyed like endpoint_urls(), or None."""
+    for service in ksc.service_catalog.get_data():
+        if service.get('name') != service_name:
+            continue
+        for endpoint in service.get('endpoints', []):
+            if endpoint.get('region') == region:
+                return {'publicurl': endpoint.get('publicURL'),
+                        'internalurl': endpoint.get('internalURL'),
+                        'adminurl': endpoint.get('adminURL')}
+    return None
+
+
+def product_streams_service_current(ksc, region):
+    """Returns True if the catalog shows the product-streams endpoint that
+    update_product_streams_service() last set in region, and the swift
+    endpoint it was derived from is unchanged."""
+    state = product_streams_state.get(region)
+    if state is None:
+        return False
+    return (catalog_endpoint_urls(ksc, 'swift', region) == state['swift'] and
+            catalog_endpoint_urls(ksc, PRODUCT_STREAMS_SERVICE_NAME,
+                                  region) == state['product_streams'])
+
+
+def tenant_id_by_name(ksc, name):
+    """Returns the id of the tenant called name, or None.
+
+    Uses keystone's server-side name lookup, rather than listing every
+    tenant in the cloud, when the client and server support it.
+    """
+    # keystoneclient has no public call for the v2 name lookup, so this
+    # relies on the private _get(); a client without it, or a server
+    # that ignores the name (answering with a tenant list) or does not
+    # know the route, is handled by listing the tenants instead
+    try:
+        tenant = ksc.tenants._get("/tenants?name={}".format(quote(name)),
+                                  "tenant")
+    except (AttributeError, KeyError, keystone_exceptions.NotFound):
+        pass
+    else:
+        return tenant.id
 
-    swift_endpoints = [e for e in endpoints
-                       if e['service_id'] == swift_service_id]
-    if len(swift_endpoints) != 1:
-        log.warning("found {} swift endpoints, expecting one - not"
-                    " updating product-streams"
-                    " endpoint.".format(len(swift_endpoints)))
-        return
+    for tenant in ksc.tenants.list():
+        if tenant.name == name:
+            return tenant.id
+    return None
 
-    swift_endpoint = swift_endpoints[0]
 
-    ps_services = [s for s in services
-                   if s['name'] == PRODUCT_STREAMS_SERVICE_NAME]
-    if len(ps_services) != 1:
-        log.error("found {} product-streams services. expecting one."
-                  " - not updating endpoint.".format(len(ps_services)))
-        return
+def update_product_streams_service(ksc, services, region):
+    """
+    Updates URLs of product-streams endpoint to point to swift URLs.
 
-    ps_service_id = ps_services[0]['id']
+    The endpoint is only replaced if its URLs differ from the ones
+    derived from swift. Either way, the URLs are remembered so that
+    product_streams_service_current() can skip the next update.
+    """
 
-    ps_endpoints = [e for e in endpoints
-                    if e['service_id'] == ps_service_id]
+    service_ids = {}
+    for s in services:
+        service_ids.setdefault(s['name'], []).append(s['id'])
 
-    if len(ps_endpoints) != 1:
-        log.warning("found {} product-streams endpoints in region {},"
-                    " expecting one - not updating"
-                    " endpoint".format(ps_endpoints, region,
-                                       len(ps_endpoints)))
+    if len(service_ids.get('swift', [])) != 1:
+        log.error("found {} swift services. expecting one."
+                  " - not updating endpoint.".format(
+                      len(service_ids.get('swift', []))))
         return
 
-    log.info("Deleting existing product-streams endpoint: ")
-    ksc.endpoints.delete(ps_endpoints[0]['id'])
+    ps_service_ids = service_ids.get(PRODUCT_STREAMS_SERVICE_NAME, [])
+    if len(ps_service_ids) != 1:
+        log.error("found {} product-streams services. expecting one."
+                  " - not updating endpoint.".format(len(ps_service_ids)))
+        return
 
-    services_tenant_ids = [t.id for t in ksc.tenants.list()
-                           if t.name == 'services']
+    ps_service_id = ps_service_ids[0]
 
-    if len(services_tenant_ids) != 1:
-        log.warning("found {} tenants named 'services',"
-                    " expecting one. Not updating"
-                    " endpoint".format(len(services_tenant_ids)))
+    swift_urls = catalog_endpoint_urls(ksc, 'swift', region)
+    if swift_urls is None:
+        log.warning("found no swift endpoint in region {} - not"
+                    " updating product-streams endpoint.".format(region))
+        return
 
-    services_tenant_id = services_tenant_ids[0]
+    services_tenant_id = tenant_id_by_name(ksc, 'services')
+    if services_tenant_id is None:
+        log.warning("found no tenant named 'services'. Not updating"
+                    " endpoint")
+        return
 
     path = "/v1/AUTH_{}/{}".format(services_tenant_id,
                                    SWIFT_DATA_DIR)
 
-    swift_public_url = swift_endpoint['publicurl']
+    swift_public_url = swift_urls['publicurl']
     sr_p = urlsplit(swift_public_url)
     ps_public_url = sr_p._replace(path=path).geturl()
 
-    swift_internal_url = swift_endpoint['internalurl']
+    swift_internal_url = swift_urls['internalurl']
     sr_i = urlsplit(swift_internal_url)
     ps_internal_url = sr_i._replace(path=path).geturl()
 
-    create_args = dict(region=region,
-                       service_id=ps_service_id,
-                       publicurl=ps_public_url,
-                       adminurl=swift_endpoint['adminurl'],
-                       internalurl=ps_internal_url)
-    log.info("creating product-streams endpoint: {}".format(create_args))
-    ksc.endpoints.create(**create_args)
+    ps_urls = dict(publicurl=ps_public_url,
+                   adminurl=swift_urls['adminurl'],
+                   internalurl=ps_internal_url)
+
+    if catalog_endpoint_urls(ksc, PRODUCT_STREAMS_SERVICE_NAME,
+                             region) == ps_urls:
+        log.info("product-streams endpoint is up to date: {}".format(ps_urls))
+    else:
+        endpoints = {}
+        for e in ksc.endpoints.list():
+            key = (e._info['service_id'], e._info['region'])
+            endpoints.setdefault(key, []).append(e._info)
+
+        ps_endpoints = endpoints.get((ps_service_id, region), [])
+        if len(ps_endpoints) > 1:
+            log.warning("found {} product-streams endpoints in region {},"
+                        " expecting one - not updating"
+                        " endpoint".format(len(ps_endpoints), region))
+            return
+
+        if ps_endpoints and endpoint_urls(ps_endpoints[0]) == ps_urls:
+            log.info("product-streams endpoint is up to date: "
+                     "{}".format(ps_urls))
+        else:
+            if ps_endpoints:
+                log.info("Deleting existing product-streams endpoint: ")
+                ksc.endpoints.delete(ps_endpoints[0]['id'])
+
+            create_args = dict(region=region,
+                               service_id=ps_service_id,
+                               **ps_urls)
+            log.info("creating product-streams endpoint: "
+                     "{}".format(create_args))
+            ksc.endpoints.create(**create_args)
+        # the cached catalog does not list the current endpoint
+        keystone_clients.invalidate()
+
+    product_streams_state.set(region, {'swift': swift_urls,
+                                       'product_streams': ps_urls})
+
+
+class StatusSpool(object):
+    """Append-only JSON-lines file of status messages that could not be
+    published, to be replayed in order once rabbitmq is reachable.
+
+    Appends are flushed right away, but only fsynced once every
+    fsync_interval seconds and on close(), so a crash loses at most the
+    messages of the last interval. Once the file holds max_bytes,
+    further messages are dropped.
+    """
+
+    def __init__(self, filename, fsync_interval=STATUS_SPOOL_FSYNC_INTERVAL,
+                 max_bytes=STATUS_SPOOL_MAX_BYTES):
+        self.filename = filename
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.f = None
+        self.synced_at = 0
+
+    def append(self, msg):
+        """Spools msg. Returns False if the spool is full."""
+        if self.f is None:
+            dirname = os.path.dirname(self.filename)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self.f = open(self.filename, 'a')
+        if os.fstat(self.f.fileno()).st_size >= self.max_bytes:
+            return False
+        self.f.write(json.dumps(msg) + "\n")
+        self.f.flush()
+        if time.time() - self.synced_at >= self.fsync_interval:
+            self.sync()
+        return True
+
+    def sync(self):
+        if self.f is not None:
+            os.fsync(self.f.fileno())
+            self.synced_at = time.time()
+
+    def close(self):
+        if self.f is not None:
+            self.sync()
+            self.f.close()
+            self.f = None
+
+    def replay(self, publish):
+        """Publishes the spooled messages in order with publish(msg) and
+        returns their number. If publish() raises, the messages it did
+        not publish stay spooled."""
+        self.close()
+        try:
+            with open(self.filename) as f:
+                lines = f.readlines()
+        except IOError:
+            return 0
+
+        done = 0
+        try:
+            for line in lines:
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    # the tail of a write interrupted by a crash
+                    log.warning("Skipping corrupt spooled status message"
+                                " {!r}".format(line))
+                else:
+                    publish(msg)
+                done += 1
+        finally:
+            if done == len(lines):
+                os.unlink(self.filename)
+            else:
+                atomic_write(self.filename, ''.join(lines[done:]))
+        return done
 
 
 class StatusExchange:
     """Wrapper for rabbitmq status exchange connection.
 
-    If no connection exists, this attempts to create a connection
-    before sending each message.
+    send_message() only queues the message; a background thread
+    publishes queued messages over one persistent channel and producer,
+    so a slow or unreachable broker never holds up a sync. If no
+    connection exists, the publisher attempts to create one before
+    sending each message, failing over across all configured rabbitmq
+    hosts. After STATUS_BREAKER_FAILURES failed attempts in a row, it
+    stops trying for STATUS_BREAKER_COOLDOWN seconds. Messages that
+    cannot be published are appended to a StatusSpool, and are
+    published before anything else once a connection is made.
+
+    Messages sent with a key, such as the progress of one image,
+    replace a queued message with the same key, and are published at
+    most once every min_interval seconds per key. The newest message of
+    a key is always published eventually. Messages without a key are
+    never replaced, and are published in order with everything queued
+    before them. If max_pending messages are queued, the oldest keyed
+    message is dropped to make room.
     """
 
-    def __init__(self):
+    def __init__(self, max_pending=STATUS_QUEUE_SIZE,
+                 min_interval=STATUS_MIN_INTERVAL):
         self.conn = None
         self.exchange = None
+        self.producer = None
+        self.max_pending = max_pending
+        self.min_interval = min_interval
+        self.cond = threading.Condition()
+        # key -> (msg, keyed); unkeyed messages get a unique key
+        self.pending = collections.OrderedDict()
+        self.unkeyed = 0
+        self.sequence = 0
+        self.published = {}
+        self.closing = False
+        self.broker_urls = self._broker_urls(
+            conf_cache.get(ID_CONF_FILE_NAME, validate_id_conf))
+        self.failures = 0
+        self.retry_at = 0
+        self.spool = StatusSpool(STATUS_SPOOL_FILE_NAME)
+
+        self.publisher = profiler.start_thread(self._publish_loop,
+                                               "status-publisher")
+
+    def _broker_urls(self, id_conf):
+        hosts = id_conf.get('rabbit_hosts', None)
+        if hosts is None:
+            hosts = id_conf.get('rabbit_host', None)
+        if isinstance(hosts, basestring):
+            # the hooks render rabbit_hosts as a comma-separated list
+            hosts = hosts.split(',')
+
+        if not hosts:
+            log.warning("no host info in configuration, can't set up rabbit.")
+            return []
 
-        self._setup_connection()
+        return ["amqp://{}:{}@{}/{}".format(id_conf['rabbit_userid'],
+                                            id_conf['rabbit_password'],
+                                            host.strip(),
+                                            id_conf['rabbit_virtual_host'])
+                for host in hosts]
 
     def _setup_connection(self):
         """Returns True if a valid connection exists already, or if one can be
@@ -309,85 +3030,466 @@ class StatusExchange:
         if self.conn:
             return True
 
-        id_conf = read_conf(ID_CONF_FILE_NAME)
-
-        hosts = id_conf.get('rabbit_hosts', None)
-        if hosts is not None:
-            host = hosts[0]
-        else:
-            host = id_conf.get('rabbit_host', None)
-
-        if host is None:
-            log.warning("no host info in configuration, can't set up rabbit.")
+        if not self.broker_urls or time.time() < self.retry_at:
             return False
 
         try:
-            url = "amqp://{}:{}@{}/{}".format(id_conf['rabbit_userid'],
-                                              id_conf['rabbit_password'],
-                                              host,
-                                              id_conf['rabbit_virtual_host'])
-
-            self.conn = kombu.BrokerConnection(url)
+            self.conn = kombu.BrokerConnection(
+                ';'.join(self.broker_urls),
+                connect_timeout=STATUS_CONNECT_TIMEOUT,
+                failover_strategy='round-robin')
+            # tries each host once
+            self.conn.ensure_connection(max_retries=len(self.broker_urls),
+                                        interval_start=0, interval_step=0,
+                                        interval_max=0)
             self.exchange = kombu.Exchange("glance-simplestreams-sync-status")
             status_queue = kombu.Queue("glance-simplestreams-sync-status",
                                        exchange=self.exchange)
 
-            status_queue(self.conn.channel()).declare()
+            channel = self.conn.channel()
+            status_queue(channel).declare()
+            self.producer = kombu.Producer(channel, exchange=self.exchange)
+
+            replayed = self.spool.replay(self.producer.publish)
+            if replayed:
+                log.info("published {} spooled status"
+                         " messages".format(replayed))
 
         except:
             log.exception("Exception during kombu setup")
+            self._reset_connection()
+            self._failed()
             return False
 
+        log.info("connected to rabbitmq at {}".format(
+            self.conn.hostname))
+        self.failures = 0
         return True
 
-    def send_message(self, msg):
+    def _failed(self):
+        self.failures += 1
+        if self.failures >= STATUS_BREAKER_FAILURES:
+            log.warning("{} rabbitmq connection failures in a row, not"
+                        " connecting for {}s".format(self.failures,
+                                                     STATUS_BREAKER_COOLDOWN))
+            self.retry_at = time.time() + STATUS_BREAKER_COOLDOWN
+
+    def _reset_connection(self):
+        if self.conn:
+            try:
+                self.conn.close()
+            except Exception:
+                log.exception("Exception closing rabbitmq connection")
+        self.conn = None
+        self.producer = None
+
+    def send_message(self, msg, key=None):
+        with self.cond:
+            if self.closing:
+                log.warning("Status exchange closed, msg {} will be"
+                            " lost.".format(str(msg)))
+                return
+
+            if key is None:
+                self.sequence += 1
+                self.unkeyed += 1
+                key = ('', self.sequence)
+                entry = (msg, False)
+            else:
+                entry = (msg, True)
+                if key in self.pending:
+                    # keeps the queue position of the message it replaces
+                    self.pending[key] = entry
+                    profiler.record('status_coalesced')
+                    return
+
+            if len(self.pending) >= self.max_pending:
+                self._drop_oldest()
+            self.pending[key] = entry
+            self.cond.notify()
+
+    def _drop_oldest(self):
+        for key, (msg, keyed) in self.pending.items():
+            if keyed:
+                break
+        else:
+            key, (msg, keyed) = next(iter(self.pending.items()))
+            self.unkeyed -= 1
+        del self.pending[key]
+        profiler.record('status_dropped')
+        log.debug("Status queue full, dropped msg {}".format(str(msg)))
+
+    def _next_message(self):
+        """Takes the next message to publish off the queue.
+
+        Called with self.cond held. Returns (msg, None), or (None, the
+        number of seconds until a queued message is due).
+        """
+        if not self.pending:
+            return None, None
+
+        now = time.time()
+        wait = None
+        for key, (msg, keyed) in self.pending.items():
+            # everything queued before an unkeyed message, and all
+            # messages on close, are published without delay
+            if keyed and self.unkeyed == 0 and not self.closing:
+                due = self.published.get(key, 0) + self.min_interval
+                if due > now:
+                    wait = min(wait, due - now) if wait else due - now
+                    continue
+                self.published[key] = now
+            elif not keyed:
+                self.unkeyed -= 1
+            del self.pending[key]
+            return msg, None
+        return None, wait
+
+    def _publish_loop(self):
+        while True:
+            with self.cond:
+                msg, wait = self._next_message()
+                while msg is None:
+                    if self.closing and not self.pending:
+                        return
+                    self.cond.wait(wait)
+                    msg, wait = self._next_message()
+            self._publish(msg)
+
+    def _publish(self, msg):
+        if not self.broker_urls:
+            log.debug("No rabbitmq configured for msg"
+                      "{}. Message will be lost.".format(str(msg)))
+            profiler.record('status_lost')
+            return
+
         if not self._setup_connection():
-            log.warning("No rabbitmq connection available for msg"
-                        "{}. Message will be lost.".format(str(msg)))
+            self._spool(msg)
             return
 
-        with self.conn.Producer(exchange=self.exchange) as producer:
-            producer.publish(msg)
+        try:
+            with profiler.phase('status_publish'):
+                self.producer.publish(msg)
+        except Exception:
+            log.exception("Exception publishing msg {}, spooling"
+                          " it.".format(str(msg)))
+            self._reset_connection()
+            self._failed()
+            self._spool(msg)
+
+    def _spool(self, msg):
+        try:
+            if self.spool.append(msg):
+                profiler.record('status_spooled')
+                return
+            log.debug("Status spool full, msg {} will be"
+                      " lost.".format(str(msg)))
+        except (IOError, OSError):
+            log.exception("Exception spooling msg {}, message will be"
+                          " lost.".format(str(msg)))
+        profiler.record('status_lost')
 
     def close(self):
-        if self.conn:
-            self.conn.close()
+        """Publishes the queued messages, waiting at most
+        STATUS_FLUSH_TIMEOUT seconds, and closes the connection."""
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.publisher.join(STATUS_FLUSH_TIMEOUT)
+        if self.publisher.is_alive():
+            log.warning("Timed out publishing {} queued status"
+                        " messages".format(len(self.pending)))
+        else:
+            self._reset_connection()
+            self.spool.close()
 
 
-def cleanup():
+def process_start_time(pid):
+    """Returns the start time of process pid in clock ticks since boot,
+    or None if there is no such process."""
     try:
-        os.unlink(SYNC_RUNNING_FLAG_FILE_NAME)
-    except OSError as e:
-        if e.errno != 2:
-            raise e
+        with open('/proc/{}/stat'.format(pid)) as f:
+            stat = f.read()
+    except IOError:
+        return None
+    # the command name in parentheses may contain spaces
+    return int(stat.rsplit(')', 1)[1].split()[19])
 
 
-def main():
+class SyncLock(object):
+    """Makes sure only one sync runs at a time.
 
-    log.info("glance-simplestreams-sync started.")
+    The holder keeps an flock on filename and records its pid, its
+    process start time and when it took the lock there as JSON. A
+    holder that died without releasing the lock, e.g. because a child
+    process inherited it, or whose pid now belongs to another process,
+    is detected and its lock file replaced.
 
-    atexit.register(cleanup)
+    An invocation that finds the lock held leaves a rerun request in
+    rerun_file_name instead of just exiting. The holder syncs again
+    before it releases the lock, so changes that came in during a long
+    sync do not wait for the next cron run.
+    """
 
-    lockfile = open(SYNC_RUNNING_FLAG_FILE_NAME, 'w')
-    try:
-        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
-    except IOError:
-        log.info("{} is locked, exiting".format(SYNC_RUNNING_FLAG_FILE_NAME))
-        sys.exit(0)
+    def __init__(self, filename, rerun_file_name):
+        self.filename = filename
+        self.rerun_file_name = rerun_file_name
+        self.lockfile = None
+
+    def holder(self, f):
+        """Returns the holder info recorded in the open lock file f, or
+        None if it has not been written yet."""
+        f.seek(0)
+        content = f.read().strip()
+        if not content:
+            return None
+        try:
+            holder = json.loads(content)
+        except ValueError:
+            return None
+        if isinstance(holder, int):
+            # charm versions before this one wrote only the pid
+            return {'pid': holder}
+        if not isinstance(holder, dict) or 'pid' not in holder:
+            return None
+        return holder
+
+    def is_stale(self, holder):
+        if holder is None:
+            return False
+        start_time = process_start_time(holder['pid'])
+        if start_time is None:
+            return True
+        recorded = holder.get('process_start_time')
+        return recorded is not None and recorded != start_time
+
+    def acquire(self, blocking=False, daemon=False):
+        """Takes the lock and returns True, or returns False if another
+        live process holds it. With blocking, waits for that process
+        instead."""
+        while True:
+            f = open(self.filename, 'a+')
+            flags = fcntl.fcntl(f, fcntl.F_GETFD)
+            fcntl.fcntl(f, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                holder = self.holder(f)
+                if self.is_stale(holder):
+                    log.warning("removing stale lock {} of pid {}, taken at"
+                                " {}".format(self.filename, holder['pid'],
+                                             time.ctime(holder.get(
+                                                 'started', 0))))
+                    self.unlink_if_same(f)
+                    f.close()
+                    continue
+                if not blocking:
+                    f.close()
+                    return False
+                log.info("waiting for {} held by {}".format(self.filename,
+                                                           holder))
+                fcntl.flock(f, fcntl.LOCK_EX)
+
+            if not self.same_file(f):
+                # removed by its holder or as stale while we waited
+                f.close()
+                continue
+
+            pid = os.getpid()
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps({'pid': pid,
+                                'process_start_time': process_start_time(pid),
+                                'started': time.time(),
+                                'daemon': daemon}))
+            f.flush()
+            self.lockfile = f
+            # this run covers any rerun that was requested before it
+            self.take_rerun_request()
+            return True
 
-    lockfile.write(str(os.getpid()))
+    def same_file(self, f):
+        try:
+            return os.fstat(f.fileno()).st_ino == os.stat(
+                self.filename).st_ino
+        except OSError:
+            return False
 
-    id_conf, charm_conf = get_conf()
+    def unlink_if_same(self, f):
+        if self.same_file(f):
+            try:
+                os.unlink(self.filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def request_rerun(self):
+        """Asks the holder to sync again when it is done. Returns True if
+        the holder released the lock meanwhile and this process took it
+        over instead."""
+        atomic_write(self.rerun_file_name,
+                     json.dumps({'pid': os.getpid(),
+                                 'requested': time.time()}))
+        # the holder checks for requests before it releases the lock,
+        # so retry in case it released it before this request landed
+        if self.acquire():
+            return True
 
-    set_openstack_env(id_conf, charm_conf)
+        with open(self.filename) as f:
+            holder = self.holder(f)
+        log.info("{} is locked by {}, rerun requested".format(
+            self.filename, holder))
+        if holder is not None and holder.get('daemon'):
+            # wake the daemon up instead of waiting for its next poll
+            try:
+                os.kill(holder['pid'], signal.SIGHUP)
+            except OSError:
+                log.exception("could not signal the sync daemon")
+        return False
+
+    def take_rerun_request(self):
+        """Removes a pending rerun request, and returns True if there
+        was one."""
+        try:
+            os.unlink(self.rerun_file_name)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
 
-    ksc = keystone_client.Client(username=os.environ['OS_USERNAME'],
-                                 password=os.environ['OS_PASSWORD'],
-                                 tenant_id=os.environ['OS_TENANT_ID'],
-                                 auth_url=os.environ['OS_AUTH_URL'])
+    def finish(self):
+        """Releases the lock after a sync, unless a rerun was requested.
+        Returns True if the caller should sync again, still holding the
+        lock."""
+        if self.take_rerun_request():
+            return True
+        self.release()
+        # a request that landed after the check above, by an invocation
+        # that then failed to take the lock, is ours to honor
+        if os.path.exists(self.rerun_file_name) and self.acquire():
+            return True
+        return False
 
-    services = [s._info for s in ksc.services.list()]
-    servicenames = [s['name'] for s in services]
+    def release(self):
+        if self.lockfile is None:
+            return
+        self.unlink_if_same(self.lockfile)
+        self.lockfile.close()
+        self.lockfile = None
+
+
+sync_lock = SyncLock(SYNC_RUNNING_FLAG_FILE_NAME, RERUN_REQUEST_FILE_NAME)
+
+
+def cleanup():
+    sync_lock.release()
+
+
+class KeystoneClientCache(object):
+    """Hands out keystone clients that share one token and service
+    catalog.
+
+    The token is kept in a root-only file between runs, and is only
+    renewed once it is about to expire within min_lifetime seconds,
+    more than max_used of its lifetime has passed, or the credentials
+    change. simplestreams authenticates again for every
+    glance and swift mirror it sets up through openstack.get_ksclient(),
+    which is pointed at get_client() below, so a sync with a valid
+    cached token does not authenticate at all.
+    """
+
+    # the arguments of simplestreams.openstack.get_ksclient()
+    client_args = ('username', 'password', 'tenant_id', 'tenant_name',
+                   'auth_url', 'cacert', 'insecure')
+
+    def __init__(self, state_file, min_lifetime,
+                 max_used=KEYSTONE_TOKEN_MAX_USED):
+        self.state = state_file
+        self.min_lifetime = min_lifetime
+        self.max_used = max_used
+        self.lock = threading.Lock()
+        self.client = None
+        self.key = None
+
+    def _expiring(self, auth_ref):
+        stale_duration = self.min_lifetime
+        try:
+            lifetime = auth_ref.expires - auth_ref.issued
+        except (AttributeError, KeyError, TypeError):
+            # no issued_at in the token; fall back to min_lifetime
+            pass
+        else:
+            stale_duration = max(stale_duration, (1 - self.max_used) *
+                                 lifetime.total_seconds())
+        return auth_ref.will_expire_soon(stale_duration=stale_duration)
+
+    def _cached_client(self, key, kwargs):
+        cached = self.state.get(key)
+        if cached is None:
+            return None
+        try:
+            if self._expiring(keystone_access.AccessInfo.factory(**cached)):
+                return None
+            return keystone_client.Client(auth_ref=cached, **kwargs)
+        except Exception:
+            log.exception("Ignoring unusable cached keystone token")
+            return None
+
+    def get_client(self, **kwargs):
+        kwargs = dict((k, kwargs[k]) for k in self.client_args
+                      if kwargs.get(k) is not None)
+        key = hashlib.sha256(json.dumps(kwargs, sort_keys=True)).hexdigest()
+        with self.lock:
+            if (self.client is not None and key == self.key and
+                    not self._expiring(self.client.auth_ref)):
+                return self.client
+
+            client = self._cached_client(key, kwargs)
+            if client is not None:
+                profiler.record('keystone_token_cached')
+            else:
+                with profiler.phase('keystone_auth'):
+                    client = keystone_client.Client(**kwargs)
+                # only the token of the current credentials is kept
+                self.state.save({key: dict(client.auth_ref)})
+
+            self.client, self.key = client, key
+            return client
+
+    def invalidate(self):
+        """Drops the cached token, so that the next client gets a fresh
+        service catalog."""
+        with self.lock:
+            self.client = self.key = None
+            self.state.save({})
+
+
+keystone_clients = KeystoneClientCache(
+    StateFile(KEYSTONE_TOKEN_FILE_NAME, mode=0o600),
+    KEYSTONE_TOKEN_MIN_LIFETIME)
+openstack.get_ksclient = keystone_clients.get_client
+
+
+def keystone_connect():
+    return keystone_clients.get_client(username=os.environ['OS_USERNAME'],
+                                       password=os.environ['OS_PASSWORD'],
+                                       tenant_id=os.environ['OS_TENANT_ID'],
+                                       auth_url=os.environ['OS_AUTH_URL'])
+
+
+def run_sync(charm_conf, ksc, status_exchange):
+    """Updates the product-streams endpoint if needed, then syncs all
+    mirrors.
+
+    Returns False if glance is not available yet and the sync should be
+    retried soon, True once a sync was attempted.
+    """
+    # the service catalog comes with the (possibly cached) token, so
+    # the services are only listed when the endpoint may need an update
+    servicenames = [s.get('name') for s in ksc.service_catalog.get_data()]
     ps_service_exists = PRODUCT_STREAMS_SERVICE_NAME in servicenames
     swift_exists = 'swift' in servicenames
 
@@ -396,27 +3498,32 @@ def main():
                                         charm_conf['use_swift'],
                                         swift_exists))
 
-    if ps_service_exists and charm_conf['use_swift'] and swift_exists:
+    if not (ps_service_exists and charm_conf['use_swift'] and swift_exists):
+        log.info("Not updating product streams service.")
+
+    elif product_streams_service_current(ksc, charm_conf['region']):
+        log.info("Product streams service is up to date.")
+        profiler.record('product_streams_current')
+
+    else:
         log.info("Updating product streams service.")
         try:
-            update_product_streams_service(ksc, services,
-                                           charm_conf['region'])
+            with profiler.phase('update_product_streams_service'):
+                services = [s._info for s in ksc.services.list()]
+                update_product_streams_service(ksc, services,
+                                               charm_conf['region'])
         except:
             log.exception("Exception during update_product_streams_service")
 
-    else:
-        log.info("Not updating product streams service.")
-
-    should_delete_cron_poll = True
-
-    status_exchange = StatusExchange()
+    sync_attempted = True
 
     try:
         log.info("Beginning image sync")
 
         status_exchange.send_message({"status": "Started",
                                       "message": "Sync starting."})
-        do_sync(charm_conf, status_exchange)
+        with profiler.phase('do_sync'):
+            do_sync(charm_conf, status_exchange)
         ts = time.strftime("%x %X")
         completed_msg = "Sync completed at {}".format(ts)
         status_exchange.send_message({"status": "Done",
@@ -427,24 +3534,292 @@ def main():
         # found".  where {type} is 'image' and {region} is potentially
         # not empty so we only match on this substring:
         if 'endpoint for image' in e.message:
-            should_delete_cron_poll = False
+            sync_attempted = False
+            # look for it in a fresh catalog on the next attempt
+            keystone_clients.invalidate()
             log.info("Glance endpoint not found, will continue polling.")
 
     except glanceclient.exc.ClientException as e:
         log.exception("Glance Client exception during do_sync."
                       " will continue polling.")
-        should_delete_cron_poll = False
+        profiler.record('sync_failed')
+        sync_attempted = False
 
     except Exception as e:
         log.exception("Exception during do_sync")
+        profiler.record('sync_failed')
         status_exchange.send_message({"status": "Error",
                                       "message": traceback.format_exc()})
 
-    status_exchange.close()
+    return sync_attempted
+
+
+def readiness_delay(attempt):
+    """Returns the seconds to wait after the attempt-th failed attempt
+    to find glance, counting from 0."""
+    return min(READINESS_INITIAL_DELAY * 2 ** attempt, READINESS_MAX_DELAY)
+
+
+def glance_endpoint_ready(region):
+    """Returns True if the keystone catalog lists an image endpoint in
+    region."""
+    ksc = keystone_connect()
+    try:
+        ksc.service_catalog.url_for(service_type='image', attr='region',
+                                    filter_value=region)
+    except keystone_exceptions.EndpointNotFound:
+        # look for it in a fresh catalog next time
+        keystone_clients.invalidate()
+        return False
+    return True
+
+
+def wait_for_glance():
+    """Waits until the config files are complete and keystone lists a
+    glance endpoint in the configured region.
+
+    Incomplete or invalid config files are checked again every
+    READINESS_INITIAL_DELAY seconds. Only a missing glance endpoint is
+    checked again with exponential backoff, which starts over whenever
+    the config files change.
+
+    This replaces running the whole sync every minute until it gets
+    past a missing glance endpoint.
+    """
+    attempt = 0
+    stamps = None
+    while True:
+        current = conf_stamps()
+        if current != stamps:
+            stamps = current
+            attempt = 0
+        try:
+            conf = load_conf()
+        except ConfigError as e:
+            # the hooks may still fix it
+            log.error("Invalid configuration: {}".format(e))
+            conf = None
+        if conf is not None:
+            id_conf, charm_conf = conf
+            set_openstack_env(id_conf, charm_conf)
+            try:
+                with profiler.phase('readiness_check'):
+                    ready = glance_endpoint_ready(charm_conf['region'])
+            except Exception:
+                log.exception("Exception looking up the glance endpoint")
+                keystone_clients.invalidate()
+            else:
+                if ready:
+                    log.info("glance endpoint found.")
+                    return
+                log.info("no glance endpoint in region {}"
+                         " yet.".format(charm_conf['region']))
+
+        if conf is None:
+            # waiting for the hooks, not for glance
+            delay = READINESS_INITIAL_DELAY
+            log.info("checking the configuration again in "
+                     "{}s".format(delay))
+        else:
+            delay = readiness_delay(attempt)
+            log.info("checking for glance again in {}s".format(delay))
+            attempt += 1
+        time.sleep(delay)
+
 
-    if os.path.exists(CRON_POLL_FILENAME) and should_delete_cron_poll:
+class SyncDaemon(object):
+    """Syncs from one long-lived process every `frequency`, instead of
+    from a fresh process per cron run.
+
+    The status exchange connection is kept between syncs, keystone
+    clients come from keystone_clients like in a cron run, and the
+    config files are only re-read when they change. SIGHUP
+    (`initctl reload glance-simplestreams-sync`) starts a sync right
+    away, or right after the one in progress.
+    """
+
+    def __init__(self):
+        self.wakeup = threading.Event()
+        self.conf_stamps = None
+        self.id_conf = None
+        self.charm_conf = None
+        self.status_exchange = None
+        self.metrics_server = None
+        # (start time, sync_attempted) of the last sync
+        self.last_sync = None
+        # syncs in a row that found glance not ready
+        self.retries = 0
+
+    def trigger(self, signum, frame):
+        log.info("sync requested by signal {}".format(signum))
+        self.wakeup.set()
+
+    def terminate(self, signum, frame):
+        log.info("stopping on signal {}".format(signum))
+        sys.exit(0)
+
+    def reload_conf(self):
+        stamps = conf_stamps()
+        if stamps == self.conf_stamps:
+            return
+        self.conf_stamps = stamps
+        # a glance that was not ready may be found with the new settings
+        self.retries = 0
+
+        log.info("reading configuration")
+        try:
+            id_conf, charm_conf = load_conf() or (None, None)
+        except ConfigError as e:
+            # keep waiting until the files change again
+            log.error("Invalid configuration: {}".format(e))
+            id_conf, charm_conf = None, None
+        if id_conf != self.id_conf:
+            # rabbit settings may have changed
+            if self.status_exchange is not None:
+                self.status_exchange.close()
+                self.status_exchange = None
+        self.id_conf, self.charm_conf = id_conf, charm_conf
+        if charm_conf is not None:
+            set_log_level(charm_conf.get('log_level', 'DEBUG'))
+            self.update_metrics_server()
+
+    def update_metrics_server(self):
+        port = int(self.charm_conf.get('metrics_port', 0))
+        if self.metrics_server is not None:
+            if self.metrics_server.port == port:
+                return
+            self.metrics_server.close()
+            self.metrics_server = None
+        if port:
+            log.info("serving metrics on port {}".format(port))
+            try:
+                self.metrics_server = MetricsServer(port)
+            except Exception:
+                log.exception("Exception starting metrics server")
+                return
+            export_metrics(self.charm_conf, self.metrics_server,
+                           report=self.last_sync is not None)
+
+    def next_sync(self):
+        if self.last_sync is None:
+            return time.time()
+        started, sync_attempted = self.last_sync
+        if not sync_attempted:
+            return started + readiness_delay(max(self.retries - 1, 0))
+        frequency = self.charm_conf.get('frequency', 'daily')
+        return started + DAEMON_INTERVALS.get(frequency,
+                                              DAEMON_INTERVALS['daily'])
+
+    def wait(self):
+        """Sleeps until a sync is due or requested, picking up config
+        changes meanwhile."""
+        while True:
+            self.reload_conf()
+            delay = DAEMON_CONF_POLL_INTERVAL
+            if self.charm_conf is not None:
+                delay = min(delay, self.next_sync() - time.time())
+                if delay <= 0:
+                    return
+            self.wakeup.wait(delay)
+            if sync_lock.take_rerun_request():
+                log.info("sync requested by another invocation")
+                # the signal that came with the request is covered too
+                self.wakeup.clear()
+                self.reload_conf()
+                if self.charm_conf is not None:
+                    return
+            if self.wakeup.is_set():
+                self.wakeup.clear()
+                self.reload_conf()
+                if self.charm_conf is not None:
+                    return
+
+    def sync(self):
+        start_log_run()
+        set_openstack_env(self.id_conf, self.charm_conf)
+        profiler.reset(profile=self.charm_conf.get('profile_sync', False))
+        try:
+            ksc = keystone_connect()
+            if self.status_exchange is None:
+                self.status_exchange = StatusExchange()
+            return run_sync(self.charm_conf, ksc, self.status_exchange)
+        except Exception:
+            log.exception("Exception during sync, will retry")
+            profiler.record('sync_failed')
+            keystone_clients.invalidate()
+            return False
+        finally:
+            profiler.finish()
+            export_metrics(self.charm_conf, self.metrics_server)
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.trigger)
+        signal.signal(signal.SIGTERM, self.terminate)
+        log.info("running as daemon")
+        while True:
+            self.wait()
+            started = time.time()
+            sync_attempted = self.sync()
+            self.last_sync = (started, sync_attempted)
+            self.retries = 0 if sync_attempted else self.retries + 1
+            log.info("sync done, next sync at {}".format(
+                time.ctime(self.next_sync())))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running and sync every `frequency`")
+    parser.add_argument('--wait-for-glance', action='store_true',
+                        help="sync once keystone lists a glance endpoint")
+    args = parser.parse_args(argv)
+
+    log.info("glance-simplestreams-sync started.")
+
+    atexit.register(cleanup)
+
+    if args.daemon:
+        sync_lock.acquire(blocking=True, daemon=True)
+        SyncDaemon().run()
+
+    if args.wait_for_glance:
+        wait_for_glance()
+
+    if not sync_lock.acquire() and not sync_lock.request_rerun():
+        sys.exit(0)
+
+    while True:
+        id_conf, charm_conf = get_conf()
+
+        set_openstack_env(id_conf, charm_conf)
+        set_log_level(charm_conf.get('log_level', 'DEBUG'))
+
+        profiler.reset(profile=charm_conf.get('profile_sync', False))
+
+        ksc = keystone_connect()
+
+        status_exchange = StatusExchange()
+
+        sync_attempted = run_sync(charm_conf, ksc, status_exchange)
+
+        status_exchange.close()
+        profiler.finish()
+        export_metrics(charm_conf)
+
+        if not sync_lock.finish():
+            break
+        log.info("rerun requested during the sync, syncing again.")
+        start_log_run()
+
+    # left behind by charm versions that polled from cron every minute
+    if os.path.exists(CRON_POLL_FILENAME) and sync_attempted:
         os.unlink(CRON_POLL_FILENAME)
         log.info("Initial sync attempt done. every-minute cronjob removed.")
+
+    if args.wait_for_glance and not sync_attempted:
+        # glance went away again, let upstart respawn the wait
+        log.info("sync not attempted, exiting with an error.")
+        sys.exit(1)
     log.info("sync done.")
 
 
@@ -0,0 +1,66 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+from test_utils import SyncScriptTestCase, gss
+
+
+class ContentWritersTest(SyncScriptTestCase):
+
+    def setUp(self):
+        super(ContentWritersTest, self).setUp()
+        self.writers = gss.ContentWriters()
+
+    def test_single_writer_did_not_race(self):
+        with self.writers.writing('a') as raced:
+            pass
+        self.assertFalse(raced)
+
+    def test_only_last_overlapping_writer_raced(self):
+        first = self.writers.writing('a')
+        second = self.writers.writing('a')
+        raced_first = first.__enter__()
+        raced_second = second.__enter__()
+        first.__exit__(None, None, None)
+        second.__exit__(None, None, None)
+        self.assertFalse(raced_first)
+        self.assertTrue(raced_second)
+
+    def test_other_content_ids_do_not_race(self):
+        with self.writers.writing('a') as raced_a:
+            with self.writers.writing('b') as raced_b:
+                pass
+        self.assertFalse(raced_a)
+        self.assertFalse(raced_b)
+
+    def test_overlap_is_forgotten_once_reported(self):
+        with self.writers.writing('a'):
+            with self.writers.writing('a'):
+                pass
+        with self.writers.writing('a') as raced:
+            pass
+        self.assertFalse(raced)
+
+    def test_failed_writer_still_counts(self):
+        try:
+            with self.writers.writing('a'):
+                with self.writers.writing('a'):
+                    raise ValueError()
+        except ValueError:
+            pass
+        with self.writers.writing('a') as raced:
+            pass
+        self.assertFalse(raced)
@@ -0,0 +1,87 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from test_utils import SyncScriptTestCase, gss
+
+
+class FakeStatusExchange(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, msg):
+        self.messages.append(msg)
+
+
+class DoSyncTest(SyncScriptTestCase):
+
+    def setUp(self):
+        super(DoSyncTest, self).setUp()
+        self.errors = {}
+        self.synced = []
+        self.results = []
+        self.lock = threading.Lock()
+        self.status = FakeStatusExchange()
+        self.patch('sync_mirror', self.sync_mirror)
+        self.patch('record_mirror_result',
+                   lambda label, success: self.results.append(
+                       (label, success)))
+        self.patch('ResumableDownload', type(
+            'FakeDownload', (object,), {'expire': staticmethod(lambda: 0)}))
+
+    def patch(self, name, value):
+        self.addCleanup(setattr, gss, name, getattr(gss, name))
+        setattr(gss, name, value)
+
+    def sync_mirror(self, charm_conf, mirror_info, status_exchange):
+        with self.lock:
+            self.synced.append(mirror_info['url'])
+        error = self.errors.get(mirror_info['url'])
+        if error is not None:
+            raise error
+        return True
+
+    def do_sync(self, urls, workers=1):
+        charm_conf = {'mirror_list': [{'url': url} for url in urls],
+                      'max_concurrent_mirrors': workers}
+        gss.do_sync(charm_conf, self.status)
+
+    def test_failure_does_not_stop_other_mirrors(self):
+        self.errors['b'] = ValueError("broken")
+        self.assertRaises(ValueError, self.do_sync, ['a', 'b', 'c'])
+        self.assertEqual(self.synced, ['a', 'b', 'c'])
+        self.assertEqual(self.results, [('a', True), ('b', False),
+                                        ('c', True)])
+
+    def test_glance_not_ready_is_not_a_mirror_failure(self):
+        self.errors['b'] = gss.keystone_exceptions.EndpointNotFound(
+            "PublicURL endpoint for image service not found")
+        self.assertRaises(gss.keystone_exceptions.EndpointNotFound,
+                          self.do_sync, ['a', 'b', 'c'])
+        self.assertEqual(self.synced, ['a', 'b'])
+        self.assertEqual(self.results, [('a', True)])
+        self.assertFalse([m for m in self.status.messages
+                          if 'failed' in m['message']])
+
+    def test_glance_not_ready_is_raised_ahead_of_failures(self):
+        self.errors['a'] = ValueError("broken")
+        self.errors['b'] = gss.glanceclient.exc.ClientException()
+        self.assertRaises(gss.glanceclient.exc.ClientException,
+                          self.do_sync, ['a', 'b'], workers=2)
+        self.assertEqual(self.results, [('a', False)])
@@ -0,0 +1,109 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+from test_utils import SyncScriptTestCase, dead_pid, gss
+
+CONTENT_ID = 'com.ubuntu.cloud:released:test'
+ITEM = {'id': 'image-1', 'name': 'trusty-amd64', 'sha256': '0' * 64}
+
+
+def glance_target(*items):
+    """Returns a target tree like GlanceMirror.load_products() builds
+    from glance, with one version and item per product in items."""
+    target = {'content_id': CONTENT_ID, 'products': {}}
+    for product, data in items:
+        target['products'][product] = {
+            'versions': {'20150101': {'items': {'disk1.img': data}}}}
+    return target
+
+
+class ImageIndexTest(SyncScriptTestCase):
+
+    def setUp(self):
+        super(ImageIndexTest, self).setUp()
+        self.index = gss.ImageIndex(self.path('image-index.json'),
+                                    max_age=3600)
+
+    def kill_sync(self, token):
+        """Makes the sync that holds token look like it was killed."""
+        def dead(entry):
+            for marker in entry['syncing']:
+                if marker['token'] == token:
+                    marker['pid'] = dead_pid()
+            return entry
+        self.index.state.modify(CONTENT_ID, dead)
+
+    def test_missing_entry(self):
+        self.assertIsNone(self.index.products(CONTENT_ID))
+
+    def test_replace_and_record(self):
+        self.index.replace(CONTENT_ID, glance_target(('p1', ITEM)))
+        token = self.index.begin(CONTENT_ID)
+        other = dict(ITEM, id='image-2')
+        self.index.record(CONTENT_ID,
+                          [(('p2', '20150101', 'disk1.img'), other)],
+                          [('p1', '20150101', 'disk1.img')])
+        self.index.end(CONTENT_ID, token)
+
+        products = self.index.products(CONTENT_ID)['products']
+        self.assertEqual(list(products), ['p2'])
+        self.assertEqual(
+            products['p2']['versions']['20150101']['items']['disk1.img'],
+            other)
+
+    def test_running_sync_hides_index_from_others(self):
+        self.index.replace(CONTENT_ID, glance_target(('p1', ITEM)))
+        token = self.index.begin(CONTENT_ID)
+        self.assertIsNone(self.index.products(CONTENT_ID))
+        self.assertIsNotNone(self.index.products(CONTENT_ID, token))
+
+        # a rebuild keeps the marker of a sync that still runs
+        self.index.replace(CONTENT_ID, glance_target(('p1', ITEM)))
+        self.assertIsNone(self.index.products(CONTENT_ID))
+        self.index.end(CONTENT_ID, token)
+        self.assertIsNotNone(self.index.products(CONTENT_ID))
+
+    def test_killed_sync_forces_one_rebuild(self):
+        self.index.replace(CONTENT_ID, glance_target(('p1', ITEM)))
+        self.kill_sync(self.index.begin(CONTENT_ID))
+
+        # the next sync has to list glance, and rebuilds the entry
+        token = self.index.begin(CONTENT_ID)
+        self.assertIsNone(self.index.products(CONTENT_ID, token))
+        self.index.replace(CONTENT_ID, glance_target(('p1', ITEM)))
+        self.index.end(CONTENT_ID, token)
+
+        self.assertEqual(self.index.state.get(CONTENT_ID)['syncing'], [])
+        self.assertIsNotNone(self.index.products(CONTENT_ID))
+
+    def test_plain_token_markers_are_dropped(self):
+        self.index.replace(CONTENT_ID, glance_target(('p1', ITEM)))
+        self.index.state.modify(CONTENT_ID, lambda entry: dict(
+            entry, syncing=['0123456789abcdef']))
+        self.assertIsNone(self.index.products(CONTENT_ID))
+        self.index.replace(CONTENT_ID, glance_target(('p1', ITEM)))
+        self.assertIsNotNone(self.index.products(CONTENT_ID))
+
+    def test_expired_entry(self):
+        index = gss.ImageIndex(self.path('expired.json'), max_age=-1)
+        index.replace(CONTENT_ID, glance_target(('p1', ITEM)))
+        self.assertIsNone(index.products(CONTENT_ID))
+
+    def test_abort_drops_entry(self):
+        self.index.replace(CONTENT_ID, glance_target(('p1', ITEM)))
+        self.index.abort(CONTENT_ID)
+        self.assertIsNone(self.index.state.get(CONTENT_ID))
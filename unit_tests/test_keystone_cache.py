@@ -0,0 +1,60 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+
+from test_utils import SyncScriptTestCase, gss
+
+
+class FakeAuthRef(object):
+    """The parts of a keystoneclient AccessInfo the cache looks at."""
+
+    def __init__(self, age, lifetime, issued=True):
+        now = datetime.datetime.utcnow()
+        if issued:
+            self.issued = now - datetime.timedelta(seconds=age)
+        self.expires = now + datetime.timedelta(seconds=lifetime - age)
+
+    def will_expire_soon(self, stale_duration):
+        soon = (datetime.datetime.utcnow() +
+                datetime.timedelta(seconds=stale_duration))
+        return self.expires < soon
+
+
+class KeystoneClientCacheTest(SyncScriptTestCase):
+
+    def setUp(self):
+        super(KeystoneClientCacheTest, self).setUp()
+        self.cache = gss.KeystoneClientCache(
+            gss.StateFile(self.path('token.json')), min_lifetime=600,
+            max_used=0.1)
+
+    def test_fresh_token_is_reused(self):
+        self.assertFalse(self.cache._expiring(FakeAuthRef(60, 3600)))
+
+    def test_partly_used_token_is_renewed(self):
+        # 50 minutes left would not last through a long mirror sync
+        self.assertTrue(self.cache._expiring(FakeAuthRef(600, 3600)))
+
+    def test_long_lived_token_is_reused_longer(self):
+        self.assertFalse(self.cache._expiring(FakeAuthRef(3600, 86400)))
+
+    def test_token_without_issue_time(self):
+        self.assertFalse(self.cache._expiring(
+            FakeAuthRef(600, 3600, issued=False)))
+        self.assertTrue(self.cache._expiring(
+            FakeAuthRef(3100, 3600, issued=False)))
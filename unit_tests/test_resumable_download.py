@@ -0,0 +1,144 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import hashlib
+import os
+import re
+import threading
+import time
+
+from test_utils import SyncScriptTestCase, gss
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """Serves server.data, tagged server.etag, with Range and If-Range
+    support. A response is cut off after server.drop_after bytes,
+    once, and is sent after server.delay seconds."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        time.sleep(server.delay)
+        data = server.data
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range',
+                                      server.etag) == server.etag:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.send_header('ETag', server.etag)
+        self.end_headers()
+
+        body = data[start:]
+        if server.drop_after is not None:
+            body = body[:server.drop_after]
+            server.drop_after = None
+        self.wfile.write(body)
+
+
+class ResumableDownloadTest(SyncScriptTestCase):
+
+    def setUp(self):
+        super(ResumableDownloadTest, self).setUp()
+        self.server = HTTPServer(('127.0.0.1', 0), ImageHandler)
+        self.server.data = os.urandom(10000)
+        self.server.etag = '"image-v1"'
+        self.server.drop_after = None
+        self.server.delay = 0
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}/image.img'.format(
+            self.server.server_port)
+
+    def download(self, **kwargs):
+        data = self.server.data
+        args = dict(size=len(data), sha256=hashlib.sha256(data).hexdigest(),
+                    download_dir=self.path('partial'), checkpoint_bytes=1024)
+        args.update(kwargs)
+        return gss.ResumableDownload(self.url, **args)
+
+    def test_complete_download(self):
+        download = self.download()
+        with open(download.fetch(), 'rb') as f:
+            self.assertEqual(f.read(), self.server.data)
+        self.assertEqual(download.checksums.size, len(self.server.data))
+
+    def test_dropped_connection_resumes(self):
+        self.server.drop_after = 4500
+        self.assertRaises(IOError, self.download().fetch)
+        # the partial file and its checkpoint are kept
+        self.assertEqual(self.download().state.load()['offset'], 4500)
+
+        download = self.download()
+        with open(download.fetch(), 'rb') as f:
+            self.assertEqual(f.read(), self.server.data)
+        self.assertEqual(self.server.requests[-1]['range'], 'bytes=4500-')
+        self.assertEqual(self.server.requests[-1]['if-range'], '"image-v1"')
+
+    def test_changed_upstream_starts_over(self):
+        self.server.drop_after = 4500
+        self.assertRaises(IOError, self.download().fetch)
+
+        self.server.data = os.urandom(10000)
+        self.server.etag = '"image-v2"'
+        self.server.requests = []
+        download = self.download()
+        with open(download.fetch(), 'rb') as f:
+            self.assertEqual(f.read(), self.server.data)
+        # the resume was asked for, but If-Range got the whole file
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0]['range'], 'bytes=4500-')
+
+    def test_digest_mismatch_discards_download(self):
+        download = self.download(sha256='0' * 64)
+        self.assertRaises(IOError, download.fetch)
+        self.assertFalse(os.path.exists(download.path))
+        self.assertFalse(os.path.exists(download.state.filename))
+
+    def test_finished_download_is_reused(self):
+        self.download().fetch()
+        self.server.requests = []
+        self.download().fetch()
+        self.assertEqual(self.server.requests, [])
+
+    def test_concurrent_downloads_share_the_file(self):
+        self.server.delay = 0.2
+        paths = []
+        threads = [threading.Thread(
+            target=lambda: paths.append(self.download().fetch()))
+            for n in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(paths), 2)
+        with open(paths[0], 'rb') as f:
+            self.assertEqual(f.read(), self.server.data)
@@ -0,0 +1,64 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from test_utils import SyncScriptTestCase, gss
+
+
+class SignatureCacheTest(SyncScriptTestCase):
+
+    def setUp(self):
+        super(SignatureCacheTest, self).setUp()
+        self.keyring = self.path('keyring.gpg')
+        self.write_keyring(b'key one')
+        self.cache = gss.SignatureCache(self.path('cache'), self.keyring,
+                                        max_entries=10)
+        self.verified = []
+        orig = gss.read_signed
+        gss.read_signed = self.fake_read_signed
+        self.addCleanup(setattr, gss, 'read_signed', orig)
+
+    def write_keyring(self, content):
+        with open(self.keyring, 'wb') as f:
+            f.write(content)
+
+    def fake_read_signed(self, content, keyring):
+        self.verified.append(content)
+        return content.upper()
+
+    def test_verified_payload_is_reused(self):
+        self.assertEqual(self.cache.read_signed('doc'), 'DOC')
+        self.assertEqual(self.cache.read_signed('doc'), 'DOC')
+        self.assertEqual(self.verified, ['doc'])
+
+    def test_changed_keyring_is_noticed_mid_run(self):
+        self.cache.read_signed('doc')
+        self.write_keyring(b'key two, replacing key one')
+        self.cache.read_signed('doc')
+        self.assertEqual(self.verified, ['doc', 'doc'])
+
+    def test_replaced_keyring_clears_cache(self):
+        self.cache.read_signed('doc')
+        new = self.path('keyring.new')
+        with open(new, 'wb') as f:
+            f.write(b'key two')
+        os.rename(new, self.keyring)
+        self.cache.read_signed('other')
+        payloads = [n for n in os.listdir(self.path('cache'))
+                    if n.endswith('.payload')]
+        self.assertEqual(len(payloads), 1)
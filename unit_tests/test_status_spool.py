@@ -0,0 +1,78 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from test_utils import SyncScriptTestCase, gss
+
+
+class PublishError(Exception):
+    pass
+
+
+class StatusSpoolTest(SyncScriptTestCase):
+
+    def setUp(self):
+        super(StatusSpoolTest, self).setUp()
+        self.spool = gss.StatusSpool(self.path('spool', 'status.jsonl'))
+        self.addCleanup(self.spool.close)
+
+    def test_replay_in_order(self):
+        for n in range(3):
+            self.assertTrue(self.spool.append({'n': n}))
+        published = []
+        self.assertEqual(self.spool.replay(published.append), 3)
+        self.assertEqual(published, [{'n': 0}, {'n': 1}, {'n': 2}])
+        self.assertFalse(os.path.exists(self.spool.filename))
+
+    def test_replay_keeps_unpublished_messages(self):
+        for n in range(4):
+            self.spool.append({'n': n})
+        published = []
+
+        def fail_on_third(msg):
+            if len(published) == 2:
+                raise PublishError()
+            published.append(msg)
+
+        self.assertRaises(PublishError, self.spool.replay, fail_on_third)
+        self.assertEqual(published, [{'n': 0}, {'n': 1}])
+
+        # new messages go after the ones still spooled
+        self.spool.append({'n': 4})
+        published = []
+        self.assertEqual(self.spool.replay(published.append), 3)
+        self.assertEqual(published, [{'n': 2}, {'n': 3}, {'n': 4}])
+
+    def test_replay_skips_corrupt_lines(self):
+        self.spool.append({'n': 0})
+        self.spool.close()
+        with open(self.spool.filename, 'a') as f:
+            f.write('{"n": \n')
+        published = []
+        self.assertEqual(self.spool.replay(published.append), 2)
+        self.assertEqual(published, [{'n': 0}])
+
+    def test_replay_without_spool(self):
+        self.assertEqual(self.spool.replay(None), 0)
+
+    def test_full_spool_drops_messages(self):
+        spool = gss.StatusSpool(self.path('full.jsonl'), max_bytes=10)
+        self.addCleanup(spool.close)
+        self.assertTrue(spool.append({'n': 0}))
+        self.assertTrue(spool.append({'n': 1}))
+        self.assertFalse(spool.append({'n': 2}))
@@ -0,0 +1,208 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import threading
+
+from test_utils import SyncScriptTestCase, gss
+
+
+def not_found():
+    return gss.swift_client.ClientException("not found", http_status=404)
+
+
+class FakeSwiftConnection(object):
+    """Keeps objects in a dict shared by every connection of a test.
+
+    put_object() of a name in fail_puts raises, and one in block_puts
+    waits for the release event first.
+    """
+
+    def __init__(self, swift):
+        self.swift = swift
+
+    def head_object(self, container, name):
+        with self.swift.lock:
+            try:
+                return dict(self.swift.objects[(container, name)][1])
+            except KeyError:
+                raise not_found()
+
+    def get_object(self, container, name):
+        with self.swift.lock:
+            try:
+                content, headers = self.swift.objects[(container, name)]
+            except KeyError:
+                raise not_found()
+        return dict(headers), content
+
+    def put_container(self, container, headers=None):
+        pass
+
+    def put_object(self, container, name, contents, content_length=None,
+                   etag=None, query_string=None, headers=None):
+        if name in self.swift.block_puts:
+            self.swift.release.wait(10)
+        if name in self.swift.fail_puts:
+            raise gss.swift_client.ClientException("put failed",
+                                                   http_status=503)
+        if not isinstance(contents, str):
+            contents = contents.read(content_length)
+        headers = dict(headers or {})
+        headers['etag'] = hashlib.md5(contents).hexdigest()
+        if query_string == 'multipart-manifest=put':
+            headers['x-static-large-object'] = 'True'
+        with self.swift.lock:
+            self.swift.objects[(container, name)] = (contents, headers)
+            self.swift.puts.append(name)
+
+    def delete_object(self, container, name, query_string=None):
+        with self.swift.lock:
+            if self.swift.objects.pop((container, name), None) is None:
+                raise not_found()
+
+    def get_container(self, container, prefix='', full_listing=False):
+        with self.swift.lock:
+            return {}, [{'name': name}
+                        for c, name in sorted(self.swift.objects)
+                        if c == container and name.startswith(prefix)]
+
+    def get_capabilities(self):
+        return {'slo': {}} if self.swift.slo else {}
+
+
+class ParallelSwiftObjectStoreTest(SyncScriptTestCase):
+
+    def setUp(self):
+        super(ParallelSwiftObjectStoreTest, self).setUp()
+        self.objects = {}
+        self.puts = []
+        self.fail_puts = set()
+        self.block_puts = set()
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.lock = threading.Lock()
+        self.slo = True
+
+        def swift_store_init(store, prefix, region=None):
+            store.container, store.path_prefix = prefix.split('/', 1)
+            store.keystone_creds = {}
+        self.patch(gss.SwiftObjectStore, '__init__', swift_store_init)
+        self.patch(gss.openstack, 'get_service_conn_info',
+                   lambda *args, **kwargs: {})
+        self.patch(gss, 'get_swiftclient', self.get_swiftclient)
+        self.patch(gss, 'SWIFT_SPOOL_DIR', self.path('spool'))
+
+    def patch(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+    def get_swiftclient(self, **kwargs):
+        return FakeSwiftConnection(self)
+
+    def store(self, **kwargs):
+        return gss.ParallelSwiftObjectStore('simplestreams/data/', **kwargs)
+
+    def test_writes_objects(self):
+        store = self.store()
+        store.insert_content('streams/v1/index.json', b'index')
+        store.close()
+        self.assertEqual(
+            self.objects[('simplestreams', 'data/streams/v1/index.json')][0],
+            b'index')
+
+    def test_index_waits_for_products(self):
+        self.block_puts.add('data/streams/v1/products.json')
+        store = self.store()
+        store.insert_content('streams/v1/products.json', b'products')
+        threading.Timer(0.2, self.release.set).start()
+        store.insert_content('streams/v1/index.json', b'index')
+        store.close()
+        self.assertEqual(self.puts, ['data/streams/v1/products.json',
+                                     'data/streams/v1/index.json'])
+
+    def test_index_is_not_written_after_failed_products(self):
+        self.fail_puts.add('data/streams/v1/products.json')
+        store = self.store()
+        store.insert_content('streams/v1/products.json', b'products')
+        self.assertRaises(gss.swift_client.ClientException,
+                          store.insert_content, 'streams/v1/index.json',
+                          b'index')
+        self.assertRaises(gss.swift_client.ClientException, store.close)
+        self.assertEqual(self.puts, [])
+
+    def test_failed_connection_does_not_use_up_the_pool(self):
+        failures = [0]
+
+        def get_swiftclient(**kwargs):
+            if failures[0] < 2:
+                failures[0] += 1
+                raise IOError("keystone unavailable")
+            return FakeSwiftConnection(self)
+        self.patch(gss, 'get_swiftclient', get_swiftclient)
+        store = self.store(workers=1)
+        for n in range(2):
+            self.assertRaises(IOError, store.connection().__enter__)
+        with store.connection() as conn:
+            self.assertTrue(isinstance(conn, FakeSwiftConnection))
+
+    def test_waiting_for_a_connection_times_out(self):
+        self.patch(gss, 'SWIFT_CONNECTION_TIMEOUT', 0.1)
+        store = self.store(workers=1)
+        with store.connection():
+            self.assertRaises(IOError, store.connection().__enter__)
+
+    def segments(self):
+        return sorted(name for container, name in self.objects
+                      if container == 'simplestreams_segments')
+
+    def insert_large(self, store, content):
+        store.insert('streams/v1/big.tar.gz',
+                     gss.contentsource.MemoryContentSource(content=content))
+
+    def test_large_object_is_segmented(self):
+        store = self.store(segment_size=4)
+        self.insert_large(store, b'0123456789')
+        store.close()
+        self.assertEqual(len(self.segments()), 3)
+
+    def test_replaced_large_object_drops_old_segments(self):
+        store = self.store(segment_size=4)
+        self.insert_large(store, b'0123456789')
+        store.close()
+        old = self.segments()
+        self.insert_large(store, b'abcdefghij')
+        store.close()
+        self.assertEqual(len(self.segments()), 3)
+        self.assertFalse(set(old) & set(self.segments()))
+
+    def test_large_object_replaced_by_small_drops_segments(self):
+        store = self.store(segment_size=4)
+        self.insert_large(store, b'0123456789')
+        store.close()
+        self.insert_large(store, b'abc')
+        store.close()
+        self.assertEqual(self.segments(), [])
+
+    def test_large_object_replaced_without_slo_drops_segments(self):
+        store = self.store(segment_size=4)
+        self.insert_large(store, b'0123456789')
+        store.close()
+        store.slo = self.slo = False
+        self.insert_large(store, b'abcdefghij')
+        store.close()
+        self.assertEqual(self.segments(), [])
@@ -0,0 +1,117 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import json
+import os
+
+from test_utils import SyncScriptTestCase, dead_pid, gss
+
+
+class SyncLockTest(SyncScriptTestCase):
+
+    def setUp(self):
+        super(SyncLockTest, self).setUp()
+        self.lock_file = self.path('sync.pid')
+        self.rerun_file = self.path('sync.rerun')
+
+    def new_lock(self):
+        # flock conflicts between open files even within one process
+        lock = gss.SyncLock(self.lock_file, self.rerun_file)
+        self.addCleanup(lock.release)
+        return lock
+
+    def hold_stale_lock(self, holder):
+        """Locks the lock file like a holder that left it behind, with
+        holder as its content, or JSON of it."""
+        f = open(self.lock_file, 'w')
+        self.addCleanup(f.close)
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if not isinstance(holder, str):
+            holder = json.dumps(holder)
+        f.write(holder)
+        f.flush()
+
+    def test_acquire_records_holder(self):
+        lock = self.new_lock()
+        self.assertTrue(lock.acquire())
+        with open(self.lock_file) as f:
+            holder = json.load(f)
+        self.assertEqual(holder['pid'], os.getpid())
+        self.assertEqual(holder['process_start_time'],
+                         gss.process_start_time(os.getpid()))
+        self.assertFalse(holder['daemon'])
+
+    def test_held_lock_is_not_acquired(self):
+        self.assertTrue(self.new_lock().acquire())
+        self.assertFalse(self.new_lock().acquire())
+
+    def test_release_removes_lock_file(self):
+        lock = self.new_lock()
+        lock.acquire()
+        lock.release()
+        self.assertFalse(os.path.exists(self.lock_file))
+        self.assertTrue(self.new_lock().acquire())
+
+    def test_rerun_request_is_honored_by_holder(self):
+        holder = self.new_lock()
+        holder.acquire()
+        blocked = self.new_lock()
+        self.assertFalse(blocked.acquire())
+        self.assertFalse(blocked.request_rerun())
+        self.assertTrue(os.path.exists(self.rerun_file))
+
+        self.assertTrue(holder.finish())
+        self.assertFalse(os.path.exists(self.rerun_file))
+        self.assertFalse(holder.finish())
+        self.assertFalse(os.path.exists(self.lock_file))
+
+    def test_rerun_request_after_release_takes_lock(self):
+        holder = self.new_lock()
+        holder.acquire()
+        blocked = self.new_lock()
+        self.assertFalse(blocked.acquire())
+        holder.release()
+        self.assertTrue(blocked.request_rerun())
+        # the run that now holds the lock covers the request
+        self.assertFalse(os.path.exists(self.rerun_file))
+
+    def test_dead_holder_is_replaced(self):
+        self.hold_stale_lock({'pid': dead_pid(), 'started': 0})
+        lock = self.new_lock()
+        self.assertTrue(lock.acquire())
+        with open(self.lock_file) as f:
+            self.assertEqual(json.load(f)['pid'], os.getpid())
+
+    def test_reused_pid_is_replaced(self):
+        start_time = gss.process_start_time(os.getpid())
+        self.hold_stale_lock({'pid': os.getpid(),
+                              'process_start_time': start_time - 1,
+                              'started': 0})
+        self.assertTrue(self.new_lock().acquire())
+
+    def test_pid_only_lock_of_live_holder_is_kept(self):
+        self.hold_stale_lock(os.getpid())
+        self.assertFalse(self.new_lock().acquire())
+
+    def test_holder_writing_its_info_is_kept(self):
+        self.hold_stale_lock("")
+        self.assertFalse(self.new_lock().acquire())
+
+    def test_unreadable_holder_is_kept(self):
+        self.hold_stale_lock('"garbage"')
+        self.assertFalse(self.new_lock().acquire())
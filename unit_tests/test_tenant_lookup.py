@@ -0,0 +1,74 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import unittest
+
+from test_utils import gss
+
+
+Tenant = collections.namedtuple('Tenant', 'id name')
+
+
+class FakeTenants(object):
+
+    def __init__(self, tenants, lookup_error=None):
+        self.tenants = tenants
+        self.lookup_error = lookup_error
+        self.listed = False
+
+    def _get(self, url, response_key):
+        if self.lookup_error is not None:
+            raise self.lookup_error
+        for tenant in self.tenants:
+            if url == "/tenants?name={}".format(tenant.name):
+                return tenant
+        raise gss.keystone_exceptions.NotFound()
+
+    def list(self):
+        self.listed = True
+        return self.tenants
+
+
+class FakeKeystoneClient(object):
+
+    def __init__(self, tenants):
+        self.tenants = tenants
+
+
+class TenantIdByNameTest(unittest.TestCase):
+
+    TENANTS = [Tenant('t1', 'admin'), Tenant('t2', 'services')]
+
+    def lookup(self, name, lookup_error=None):
+        self.tenants = FakeTenants(self.TENANTS, lookup_error)
+        return gss.tenant_id_by_name(FakeKeystoneClient(self.tenants), name)
+
+    def test_server_side_lookup(self):
+        self.assertEqual(self.lookup('services'), 't2')
+        self.assertFalse(self.tenants.listed)
+
+    def test_missing_tenant(self):
+        self.assertEqual(self.lookup('nope'), None)
+
+    def test_client_without_private_get(self):
+        self.assertEqual(self.lookup('services', AttributeError()), 't2')
+        self.assertTrue(self.tenants.listed)
+
+    def test_server_ignoring_name(self):
+        self.assertEqual(self.lookup('admin', KeyError('tenant')), 't1')
+        self.assertTrue(self.tenants.listed)
@@ -0,0 +1,70 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+
+from test_utils import SyncScriptTestCase, gss
+
+
+class FakeTransfer(object):
+
+    def __init__(self, name):
+        self.pedigree = [name]
+        self.cleaned_up = False
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+class ImageTransferPipelineTest(SyncScriptTestCase):
+
+    def setUp(self):
+        super(ImageTransferPipelineTest, self).setUp()
+        self.release = threading.Event()
+        self.uploaded = []
+        self.pipeline = gss.ImageTransferPipeline(self.download,
+                                                  self.uploaded.append,
+                                                  queue_size=2)
+        self.addCleanup(self.release.set)
+
+    def download(self, transfer):
+        self.release.wait(10)
+
+    def test_transfers_are_uploaded(self):
+        self.release.set()
+        transfers = [FakeTransfer(str(n)) for n in range(3)]
+        for transfer in transfers:
+            self.pipeline.put(transfer)
+        self.pipeline.wait()
+        self.pipeline.close()
+        self.assertEqual(self.uploaded, transfers)
+        self.assertTrue(all(t.cleaned_up for t in transfers))
+
+    def test_abort_discards_queued_transfers(self):
+        transfers = [FakeTransfer(str(n)) for n in range(2)]
+        for transfer in transfers:
+            self.pipeline.put(transfer)
+        try:
+            raise ValueError("walk failed")
+        except ValueError:
+            self.pipeline.abort(sys.exc_info())
+        self.release.set()
+        self.pipeline.close()
+        self.assertEqual(self.uploaded, [])
+        self.assertTrue(all(t.cleaned_up for t in transfers))
+        self.assertRaises(ValueError, self.pipeline.wait)
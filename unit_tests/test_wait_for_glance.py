@@ -0,0 +1,81 @@
+# Copyright 2014 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from test_utils import SyncScriptTestCase, gss
+
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.sleeps = []
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+class WaitForGlanceTest(SyncScriptTestCase):
+    """Each check consumes the next (conf_stamps, complete, ready)
+    step."""
+
+    def setUp(self):
+        super(WaitForGlanceTest, self).setUp()
+        self.steps = []
+        self.fake_time = FakeTime()
+        self.patch('time', self.fake_time)
+        self.patch('conf_stamps', lambda: self.steps[0][0])
+        self.patch('load_conf', self.load_conf)
+        self.patch('set_openstack_env', lambda id_conf, charm_conf: None)
+        self.patch('glance_endpoint_ready',
+                   lambda region: self.steps.pop(0)[2])
+        self.patch('readiness_delay', lambda attempt: 10 * 2 ** attempt)
+
+    def patch(self, name, value):
+        self.addCleanup(setattr, gss, name, getattr(gss, name))
+        setattr(gss, name, value)
+
+    def load_conf(self):
+        if not self.steps[0][1]:
+            self.steps.pop(0)
+            return None
+        return {}, {'region': 'r1'}
+
+    def run_steps(self, steps):
+        self.steps = list(steps)
+        gss.wait_for_glance()
+        return self.fake_time.sleeps
+
+    def test_backs_off_while_glance_is_missing(self):
+        self.assertEqual(self.run_steps([('a', True, False)] * 3 +
+                                        [('a', True, True)]),
+                         [10, 20, 40])
+
+    def test_incomplete_config_does_not_back_off(self):
+        self.assertEqual(self.run_steps([(None, False, None)] * 4 +
+                                        [('a', True, False),
+                                         ('a', True, True)]),
+                         [10, 10, 10, 10, 10])
+
+    def test_config_change_resets_backoff(self):
+        self.assertEqual(self.run_steps([('a', True, False)] * 3 +
+                                        [('b', True, False),
+                                         ('b', True, True)]),
+                         [10, 20, 40, 10])